@@ -4,10 +4,10 @@
 #
 # Copyright (c) Greenplum Inc 2008. All Rights Reserved.
 #
-from gppylib.mainUtils import getProgramName
-
 import copy
 import datetime
+import heapq
+import json
 import os
 import sys
 import socket
@@ -15,6 +15,98 @@ import signal
 import traceback
 from time import strftime, sleep
 
+
+def fast_status(argv):
+    """gpexpand --status.  Monitoring polls this, so it runs before gppylib is
+    imported and only reads: the gpexpand.status file of the master, then
+    either a --metrics-file or the O(1) progress tables of the gpexpand schema."""
+    from optparse import OptionParser
+    parser = OptionParser(usage='gpexpand --status [--json] [-D database_name] [--metrics-file path]')
+    parser.add_option('--status', action='store_true')
+    parser.add_option('--json', action='store_true')
+    parser.add_option('-D', '--database')
+    parser.add_option('--metrics-file')
+    (options, args) = parser.parse_args(argv)
+
+    result = {'setup_status': None, 'expansion_status': None, 'updated': None, 'progress': {}, 'in_flight': []}
+    master_data_directory = os.environ.get('MASTER_DATA_DIRECTORY')
+    if not master_data_directory:
+        sys.stderr.write('MASTER_DATA_DIRECTORY is not set\n')
+        return 2
+    status_file = os.path.join(master_data_directory, 'gpexpand.status')
+    if os.path.exists(status_file):
+        lines = [l.strip() for l in open(status_file) if l.strip()]
+        if lines:
+            result['setup_status'] = lines[-1].split(':', 1)[0]
+
+    if options.metrics_file:
+        try:
+            for line in open(options.metrics_file):
+                if line.strip() and not line.startswith('#'):
+                    (name, value) = line.rsplit(None, 1)
+                    result['progress'][name] = value
+        except IOError, e:
+            sys.stderr.write('Could not read metrics file %s: %s\n' % (options.metrics_file, e.strerror))
+            return 2
+        except ValueError:
+            sys.stderr.write('Metrics file %s is not in the gpexpand metrics format\n' % options.metrics_file)
+            return 2
+    else:
+        from pygresql import pg
+        port = os.environ.get('PGPORT')
+        if not port:
+            for line in open(os.path.join(master_data_directory, 'postgresql.conf')):
+                if line.strip().startswith('port'):
+                    port = line.split('=', 1)[1].split('#')[0].strip()
+        dbname = options.database or os.environ.get('PGDATABASE') or 'template1'
+        try:
+            db = pg.connect(dbname=dbname, port=int(port))
+        except Exception, e:
+            db = None
+            result['error'] = str(e).strip()
+        if db:
+            try:
+                if db.query("SELECT count(*) FROM pg_catalog.pg_namespace WHERE nspname = 'gpexpand'").getresult()[0][0]:
+                    rows = db.query('SELECT status, updated FROM gpexpand.status ORDER BY updated DESC LIMIT 1').getresult()
+                    if rows:
+                        (result['expansion_status'], result['updated']) = rows[0]
+                    result['progress'] = dict(db.query('SELECT name, value FROM gpexpand.expansion_progress').getresult())
+                    if db.query("""SELECT count(*) FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n
+                                  ON (c.relnamespace = n.oid)
+                                  WHERE n.nspname = 'gpexpand' AND c.relname = 'table_progress'""").getresult()[0][0]:
+                        result['in_flight'] = [
+                            {'dbname': r[0], 'table': r[1], 'percent_done': float(r[2]), 'bytes_per_second': float(r[3])}
+                            for r in db.query("""SELECT dbname, fq_name, percent_done, bytes_per_second
+                                                FROM gpexpand.table_progress ORDER BY percent_done""").getresult()]
+            finally:
+                db.close()
+
+    if options.json:
+        print json.dumps(result, default=str, sort_keys=True)
+        return 0
+    print 'Setup status:      %s' % (result['setup_status'] or 'no setup in progress')
+    if not options.metrics_file:
+        print 'Expansion status:  %s%s' % (result['expansion_status'] or 'no gpexpand schema',
+                                           ' (%s)' % result['updated'] if result['updated'] else '')
+    if 'error' in result:
+        print 'Database:          %s' % result['error']
+    for (name, value) in sorted(result['progress'].items()):
+        print '%-40s %s' % (name, value)
+    for table in result['in_flight']:
+        print '%s.%s: %.0f%% done, %.1f MB/s' % (table['dbname'], table['table'], table['percent_done'],
+                                                 table['bytes_per_second'] / 1024 / 1024)
+    return 0
+
+
+if __name__ == '__main__' and '--status' in sys.argv[1:]:
+    sys.exit(fast_status(sys.argv[1:]))
+
+# only the full run needs these; --status exits above without them
+import Queue
+import threading
+
+from gppylib.mainUtils import getProgramName
+
 try:
     from gppylib.commands.unix import *
     from gppylib.fault_injection import inject_fault
@@ -39,7 +131,6 @@ try:
     from gppylib.operations.filespace import PG_SYSTEM_FILESPACE, GP_TRANSACTION_FILES_FILESPACE, \
         GP_TEMPORARY_FILES_FILESPACE, GetCurrentFilespaceEntries, GetFilespaceEntries, GetFilespaceEntriesDict, \
         RollBackFilespaceChanges, GetMoveOperationList, FileType, UpdateFlatFiles
-    from gppylib.heapchecksum import HeapChecksum
 
 except ImportError, e:
     sys.exit('ERROR: Cannot import modules.  Please check that you have sourced greenplum_path.sh.  Detail: ' + str(e))
@@ -47,6 +138,43 @@ except ImportError, e:
 # constants
 MAX_PARALLEL_EXPANDS = 96
 MAX_BATCH_SIZE = 128
+ONLINE_MAX_CATCHUP_ROUNDS = 10
+ONLINE_CONVERGED_ROWS = 10000
+ONLINE_STATS_SETTLE_SECONDS = 1
+DRIVER_HEARTBEAT_TIMEOUT = 120
+DRIVER_HEARTBEAT_INTERVAL = 10
+HOT_TABLE_FRACTION = 0.1
+SKEW_WARNING_COEFFICIENT = 20
+SKEW_MIN_BYTES = 64 * 1024 * 1024
+MAX_SKEW_VERIFIERS = 4
+POPULATE_FETCH_ROWS = 10000
+PREPARE_WORKERS = 8
+PREFLIGHT_WORKERS = 8
+
+# --estimate calibration
+CALIBRATION_SAMPLES = 2
+CALIBRATION_ROWS = 500000
+CALIBRATION_STREAMS = 4
+ESTIMATE_TOLERANCE = 0.05
+ESTIMATE_OID_CHUNK = 10000
+
+# throughput history
+HISTORY_MIN_SAMPLES = 3
+HISTORY_CONTENTION_STEPS = 20
+
+# --metrics-port / --metrics-file
+METRICS_RATE_WINDOW = 300
+
+# in-flight table progress sampling
+TABLE_PROGRESS_INTERVAL = 60
+TABLE_PROGRESS_MIN_BYTES = 1024 * 1024 * 1024
+HEAP_SEGMENT_FILE_BYTES = 1024 * 1024 * 1024
+AOCS_FILES_PER_COLUMN = 128
+
+# catalogs that every ALTER TABLE ... REORGANIZE leaves dead tuples in
+CHURNED_CATALOG_TABLES = ['pg_class', 'pg_attribute', 'pg_type', 'pg_depend', 'pg_constraint',
+                          'pg_attrdef', 'pg_index', 'pg_statistic', 'gp_distribution_policy',
+                          'pg_appendonly', 'pg_stat_last_operation']
 
 GPDB_STOPPED = 1
 GPDB_STARTED = 2
@@ -101,6 +229,16 @@ gpexpand -i input_file [-D database_name] [-B batch_size] [-V] [-t segment_tar_d
 
 gpexpand [-d duration[hh][:mm[:ss]] | [-e 'YYYY-MM-DD hh:mm:ss']]
          [-a] [-n parallel_processes] [-D database_name]
+         [--online online_tables_file] [--cooperative]
+         [--hot-first] [--quiet-hours HH:MM-HH:MM] [--colocate colocation_hints_file]
+         [--catalog-vacuum-interval tables] [--verify-skew]
+         [--metrics-port port] [--metrics-file path] [--journal path] [--trace path]
+
+gpexpand --summarize-journal path
+
+gpexpand --status [--json] [-D database_name] [--metrics-file path]
+
+gpexpand --estimate [-n parallel_processes] [-a] [-D database_name]
 
 gpexpand -r [-D database_name]
 
@@ -149,6 +287,43 @@ def parseargs():
                       help='debug output.')
     parser.add_option('-S', '--simple-progress', action='store_true',
                       help='show simple progress.')
+    parser.add_option('--online', dest='online_file', metavar='<online_tables_file>',
+                      help='file listing tables to redistribute online, one '
+                           'dbname.schema.table:watermark_column per line.')
+    parser.add_option('--cooperative', action='store_true',
+                      help='share the redistribution with other gpexpand --cooperative drivers, '
+                           'which may run on other hosts such as the standby master.')
+    parser.add_option('--hot-first', action='store_true',
+                      help='expand the most frequently scanned tables first.')
+    parser.add_option('--quiet-hours', metavar='HH:MM-HH:MM',
+                      help='only start expanding the most frequently scanned tables '
+                           'inside this daily window.')
+    parser.add_option('--colocate', dest='colocate_file', metavar='<colocation_hints_file>',
+                      help='file listing groups of tables joined on their distribution key, one '
+                           'comma separated list of dbname.schema.table per line.')
+    parser.add_option('--catalog-vacuum-interval', type='int', default=1000, metavar='<tables>',
+                      help='vacuum the catalog of a database after this many of its tables '
+                           'were expanded, 0 disables.  Default is 1000.')
+    parser.add_option('--verify-skew', action='store_true',
+                      help='estimate the data skew of every expanded table of at least 64 MB '
+                           'and record it in gpexpand.table_skew.')
+    parser.add_option('--metrics-port', type='int', metavar='<port>',
+                      help='serve OpenMetrics of the running expansion on this port of localhost.')
+    parser.add_option('--metrics-file', metavar='<path>',
+                      help='rewrite this file with OpenMetrics of the running expansion every few seconds.')
+    parser.add_option('--journal', metavar='<path>',
+                      help='append a JSON line per setup phase, remote command and table attempt to this file.')
+    parser.add_option('--trace', metavar='<path>',
+                      help='write a per-worker timeline of the table expansions to this file '
+                           'in Chrome trace-event JSON.')
+    parser.add_option('--status', action='store_true',
+                      help='print the progress of the expansion without changing the cluster state.  '
+                           'Add --json for JSON output.')
+    parser.add_option('--json', action='store_true', help='with --status, print JSON.')
+    parser.add_option('--summarize-journal', metavar='<path>',
+                      help='print where the time recorded in a --journal file went and exit.')
+    parser.add_option('--estimate', action='store_true',
+                      help='predict how long the table expansion will take without changing any table.')
     parser.add_option('-t', '--tardir', default='.', metavar="FILE",
                       help='Tar file directory.')
     parser.add_option('-h', '-?', '--help', action='help',
@@ -168,6 +343,16 @@ def validate_options(options, args, parser):
         logger.error('Unknown argument %s' % args[0])
         parser.exit()
 
+    if options.catalog_vacuum_interval < 0:
+        logger.error('Invalid argument.  --catalog-vacuum-interval must be >= 0')
+        parser.print_help()
+        parser.exit()
+
+    if options.metrics_port is not None and not 0 < options.metrics_port < 65536:
+        logger.error('Invalid argument.  --metrics-port must be between 1 and 65535')
+        parser.print_help()
+        parser.exit()
+
     # -n sanity check
     if options.parallel > MAX_PARALLEL_EXPANDS or options.parallel < 1:
         logger.error('Invalid argument.  parallel value must be >= 1 and <= %d' % MAX_PARALLEL_EXPANDS)
@@ -210,6 +395,11 @@ def validate_options(options, args, parser):
         logger.error("%s and %s options cannot be specified together." % (rollbackOpt, cleanOpt))
         parser.exit()
 
+    # --cooperative only drives the redistribution phase
+    if options.cooperative and (options.rollback or options.clean or options.filename):
+        logger.error("--cooperative cannot be used with -i, -r or -c.")
+        parser.exit()
+
     try:
         options.master_data_directory = get_masterdatadir()
         options.gphome = get_gphome()
@@ -231,9 +421,50 @@ def validate_options(options, args, parser):
 
     options.pgport = int(os.getenv('PGPORT', 5432))
 
+    options.quiet_window = None
+    if options.quiet_hours:
+        try:
+            options.quiet_window = parse_quiet_hours(options.quiet_hours)
+        except ValueError:
+            logger.error('Invalid argument.  --quiet-hours must be in the format HH:MM-HH:MM')
+            parser.exit()
+
+    options.colocation_hints = []
+    if options.colocate_file:
+        try:
+            options.colocation_hints = read_colocation_hints_file(options.colocate_file)
+        except ExpansionError, msg:
+            logger.error(msg)
+            parser.exit()
+
+    options.online_tables = {}
+    if options.online_file:
+        try:
+            options.online_tables = read_online_tables_file(options.online_file)
+        except ExpansionError, msg:
+            logger.error(msg)
+            parser.exit()
+
     return options, args
 
 
+def parse_quiet_hours(value):
+    """Parses HH:MM-HH:MM into a (start, end) pair of datetime.time"""
+    (start, end) = value.split('-')
+    return tuple(datetime.datetime.strptime(t.strip(), '%H:%M').time() for t in (start, end))
+
+
+def in_quiet_hours(window, now=None):
+    """Returns True if now falls inside the daily window, which may wrap midnight"""
+    if now is None:
+        now = datetime.datetime.now()
+    (start, end) = window
+    t = now.time()
+    if start <= end:
+        return start <= t < end
+    return t >= start or t < end
+
+
 # -------------------------------------------------------------------------
 # process information functions
 def create_pid_file(master_data_directory):
@@ -284,6 +515,12 @@ start_status = "IN PROGRESS"
 done_status = "COMPLETED"
 does_not_exist_status = 'NO LONGER EXISTS'
 
+# phases of an online redistribution, kept in status_detail.expansion_phase
+copying_phase = 'COPYING'
+catchup_phase = 'CATCHING UP'
+swapping_phase = 'SWAPPING'
+fallback_phase = 'FALLBACK'
+
 gpexpand_schema = 'gpexpand'
 create_schema_sql = "CREATE SCHEMA " + gpexpand_schema
 drop_schema_sql = "DROP schema IF EXISTS %s CASCADE" % gpexpand_schema
@@ -307,7 +544,89 @@ status_detail_table_sql = """CREATE TABLE %s.%s
                           status text,
                           expansion_started timestamp,
                           expansion_finished timestamp,
-                          source_bytes numeric ) """ % (gpexpand_schema, status_detail_table)
+                          source_bytes numeric,
+                          expansion_phase text,
+                          claimed_by text,
+                          scan_count bigint,
+                          colocation_group text,
+                          partition_root text )
+                        DISTRIBUTED BY (table_oid) """ % (gpexpand_schema, status_detail_table)
+# built once status_detail is populated.  Every per-table update is keyed on
+# table_oid, so it is dispatched to a single segment and found by index.
+status_detail_index_sql = [
+    "CREATE INDEX status_detail_key_idx ON %s.%s (table_oid, dbname)" % (gpexpand_schema, status_detail_table),
+    "CREATE INDEX status_detail_status_idx ON %s.%s (status, rank)" % (gpexpand_schema, status_detail_table)]
+status_detail_columns = """dbname, fq_name, schema_oid, table_oid,
+                          distribution_policy, distribution_policy_names,
+                          distribution_policy_coloids, storage_options, rank,
+                          status, expansion_started, expansion_finished,
+                          source_bytes, expansion_phase, claimed_by, scan_count,
+                          colocation_group, partition_root"""
+
+drivers_table = 'drivers'
+drivers_table_sql = """CREATE TABLE %s.%s
+                        ( driver_id text,
+                          hostname text,
+                          pid int,
+                          started timestamp,
+                          heartbeat timestamp ) """ % (gpexpand_schema, drivers_table)
+table_skew_table = 'table_skew'
+table_skew_table_sql = """CREATE TABLE %s.%s
+                        ( dbname text,
+                          fq_name text,
+                          segments int,
+                          min_segment_bytes numeric,
+                          max_segment_bytes numeric,
+                          skew_coefficient numeric,
+                          verified timestamp ) """ % (gpexpand_schema, table_skew_table)
+
+table_estimates_table = 'table_estimates'
+table_estimates_table_sql = """CREATE TABLE %s.%s
+                        ( dbname text,
+                          table_oid oid,
+                          predicted_seconds numeric ) """ % (gpexpand_schema, table_estimates_table)
+
+# kept outside the gpexpand schema so that gpexpand -c leaves it in place
+history_schema = 'gpexpand_history'
+table_history_table = 'table_history'
+table_history_table_sql = """CREATE TABLE %s.%s
+                        ( dbname text,
+                          fq_name text,
+                          relstorage char,
+                          compresstype text,
+                          indexes int,
+                          source_bytes numeric,
+                          seconds numeric,
+                          concurrency int,
+                          expansion_started timestamp,
+                          expansion_finished timestamp ) """ % (history_schema, table_history_table)
+
+# tables and bytes per status, moved by ExpandTable in the transaction of each
+# status change.  The COMPLETED row also keeps the rate window: the bytes and
+# time span of the tables finished since the expansion was last started.
+progress_counters_table = 'progress_counters'
+progress_counters_table_sql = """CREATE TABLE %s.%s
+                        ( status text,
+                          tables bigint,
+                          bytes numeric,
+                          predicted_seconds numeric,
+                          window_bytes numeric,
+                          window_started timestamp,
+                          window_finished timestamp ) """ % (gpexpand_schema, progress_counters_table)
+
+# the share of every sampled in-flight ALTER TABLE written so far
+table_progress_table = 'table_progress'
+table_progress_table_sql = """CREATE TABLE %s.%s
+                        ( driver text,
+                          dbname text,
+                          fq_name text,
+                          source_bytes numeric,
+                          bytes_written numeric,
+                          percent_done numeric,
+                          bytes_per_second numeric,
+                          seconds_done numeric,
+                          sampled timestamp ) """ % (gpexpand_schema, table_progress_table)
+
 # gpexpand views
 progress_view = 'expansion_progress'
 progress_view_simple_sql = """CREATE VIEW %s.%s AS
@@ -316,9 +635,11 @@ SELECT
         WHEN '%s' THEN 'Tables Expanded'
         WHEN '%s' THEN 'Tables Left'
     END AS Name,
-    count(*)::text AS Value
-FROM %s.%s GROUP BY status""" % (gpexpand_schema, progress_view,
-                                 done_status, undone_status, gpexpand_schema, status_detail_table)
+    tables::text AS Value
+FROM %s.%s WHERE status IN ('%s', '%s') AND tables > 0""" % (gpexpand_schema, progress_view,
+                                                           done_status, undone_status,
+                                                           gpexpand_schema, progress_counters_table,
+                                                           done_status, undone_status)
 
 progress_view_sql = """CREATE VIEW %s.%s AS
 SELECT
@@ -327,8 +648,8 @@ SELECT
         WHEN '%s' THEN 'Tables Left'
         WHEN '%s' THEN 'Tables In Progress'
     END AS Name,
-    count(*)::text AS Value
-FROM %s.%s GROUP BY status
+    tables::text AS Value
+FROM %s.%s WHERE status IN ('%s', '%s', '%s') AND tables > 0
 
 UNION
 
@@ -338,91 +659,149 @@ SELECT
         WHEN '%s' THEN 'Bytes Left'
         WHEN '%s' THEN 'Bytes In Progress'
     END AS Name,
-    SUM(source_bytes)::text AS Value
-FROM %s.%s GROUP BY status
+    bytes::text AS Value
+FROM %s.%s WHERE status IN ('%s', '%s', '%s') AND tables > 0
 
 UNION
 
 SELECT
     'Estimated Expansion Rate' AS Name,
-    (SUM(source_bytes) / (1 + extract(epoch FROM (max(expansion_finished) - min(expansion_started)))) / 1024 / 1024)::text || ' MB/s' AS Value
+    (window_bytes / (1 + extract(epoch FROM (window_finished - window_started))) / 1024 / 1024)::text || ' MB/s' AS Value
 FROM %s.%s
 WHERE status = '%s'
-AND
-expansion_started > (SELECT updated FROM %s.%s WHERE status = '%s' ORDER BY updated DESC LIMIT 1)
 
 UNION
 
 SELECT
 'Estimated Time to Completion' AS Name,
-CAST((SUM(source_bytes) / (
-SELECT 1 + SUM(source_bytes) / (1 + (extract(epoch FROM (max(expansion_finished) - min(expansion_started)))))
+CAST(coalesce(sum(predicted_seconds) - (SELECT coalesce(sum(seconds_done), 0) FROM %s.%s),
+(sum(bytes) - (SELECT coalesce(sum(bytes_written), 0) FROM %s.%s)) / (
+SELECT 1 + window_bytes / (1 + extract(epoch FROM (window_finished - window_started)))
 FROM %s.%s
-WHERE status = '%s'
-AND
-expansion_started > (SELECT updated FROM %s.%s WHERE status = '%s' ORDER BY
-updated DESC LIMIT 1)))::text || ' seconds' as interval)::text AS Value
+WHERE status = '%s'))::text || ' seconds' as interval)::text AS Value
 FROM %s.%s
 WHERE status = '%s'
   OR status = '%s'""" % (gpexpand_schema, progress_view,
                          done_status, undone_status, start_status,
-                         gpexpand_schema, status_detail_table,
+                         gpexpand_schema, progress_counters_table,
+                         done_status, undone_status, start_status,
                          done_status, undone_status, start_status,
-                         gpexpand_schema, status_detail_table,
-                         gpexpand_schema, status_detail_table,
+                         gpexpand_schema, progress_counters_table,
+                         done_status, undone_status, start_status,
+                         gpexpand_schema, progress_counters_table,
                          done_status,
-                         gpexpand_schema, status_table,
-                         'EXPANSION STARTED',
-                         gpexpand_schema, status_detail_table,
+                         gpexpand_schema, table_progress_table,
+                         gpexpand_schema, table_progress_table,
+                         gpexpand_schema, progress_counters_table,
                          done_status,
-                         gpexpand_schema, status_table,
-                         'EXPANSION STARTED',
-                         gpexpand_schema, status_detail_table,
+                         gpexpand_schema, progress_counters_table,
                          start_status, undone_status)
 
-unalterable_table_sql = """
+skewed_tables_view = 'skewed_tables'
+skewed_tables_view_sql = """CREATE VIEW %s.%s AS
+SELECT dbname, fq_name, skew_coefficient, min_segment_bytes, max_segment_bytes, verified
+FROM %s.%s
+WHERE skew_coefficient > %d
+ORDER BY skew_coefficient DESC""" % (gpexpand_schema, skewed_tables_view,
+                                     gpexpand_schema, table_skew_table, SKEW_WARNING_COEFFICIENT)
+
+segment_movement_table = 'segment_movement'
+segment_movement_table_sql = """CREATE TABLE %s.%s
+                        ( driver text,
+                          content smallint,
+                          hostname text,
+                          bytes_in numeric,
+                          bytes_out numeric,
+                          updated timestamp ) """ % (gpexpand_schema, segment_movement_table)
+
+segment_progress_view = 'segment_progress'
+segment_progress_view_sql = """CREATE VIEW %s.%s AS
+SELECT content, hostname, sum(bytes_in) AS bytes_in, sum(bytes_out) AS bytes_out, max(updated) AS updated
+FROM %s.%s
+GROUP BY content, hostname
+ORDER BY content""" % (gpexpand_schema, segment_progress_view, gpexpand_schema, segment_movement_table)
+
+host_progress_view = 'host_progress'
+host_progress_view_sql = """CREATE VIEW %s.%s AS
+SELECT hostname, count(DISTINCT content) AS segments,
+       sum(bytes_in) AS bytes_in, sum(bytes_out) AS bytes_out, max(updated) AS updated
+FROM %s.%s
+GROUP BY hostname
+ORDER BY hostname""" % (gpexpand_schema, host_progress_view, gpexpand_schema, segment_movement_table)
+
+partition_progress_view = 'partition_progress'
+partition_progress_view_sql = """CREATE VIEW %s.%s AS
 SELECT
-    current_database() AS database,
-    pg_catalog.quote_ident(nspname) || '.' ||
-    pg_catalog.quote_ident(relname) AS table,
-    attnum,
-    attlen,
-    attbyval,
-    attstorage,
-    attalign,
-    atttypmod,
-    attndims,
-    reltoastrelid != 0 AS istoasted
-FROM
-    pg_catalog.pg_attribute,
-    pg_catalog.pg_class,
-    pg_catalog.pg_namespace
-WHERE
-    attisdropped
-    AND attnum >= 0
-    AND attrelid = pg_catalog.pg_class.oid
-    AND relnamespace = pg_catalog.pg_namespace.oid
-    AND (attlen, attbyval, attalign, attstorage) NOT IN
-        (SELECT typlen, typbyval, typalign, typstorage
-        FROM pg_catalog.pg_type
-        WHERE typisdefined AND typtype='b' )
-ORDER BY
-    attrelid, attnum
+    dbname,
+    partition_root,
+    count(*) AS leaves,
+    sum(CASE WHEN status = '%s' THEN 1 ELSE 0 END) AS leaves_expanded,
+    sum(CASE WHEN status = '%s' THEN 1 ELSE 0 END) AS leaves_in_progress,
+    sum(CASE WHEN status = '%s' THEN 1 ELSE 0 END) AS leaves_left,
+    sum(CASE WHEN status = '%s' THEN source_bytes ELSE 0 END) AS bytes_expanded,
+    sum(source_bytes) AS bytes_total,
+    min(expansion_started) AS expansion_started,
+    CASE WHEN sum(CASE WHEN status IN ('%s', '%s') THEN 1 ELSE 0 END) = 0
+         THEN max(expansion_finished) END AS expansion_finished
+FROM %s.%s
+WHERE partition_root IS NOT NULL
+GROUP BY dbname, partition_root""" % (gpexpand_schema, partition_progress_view,
+                                       done_status, start_status, undone_status, done_status,
+                                       start_status, undone_status,
+                                       gpexpand_schema, status_detail_table)
+
+gpexpand_status_exists_sql = """
+SELECT count(*)
+FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON (c.relnamespace = n.oid)
+WHERE n.nspname = 'gpexpand' AND c.relname = 'status'
 """
 
-has_unique_index_sql = """
+# the user tables the pre-flight checks flag, in one scan per database: the
+# ones with a unique index and the ones with dropped columns of non-base types
+flagged_tables_sql = """
 SELECT
-    current_database() || '.' || pg_catalog.quote_ident(nspname) || '.' || pg_catalog.quote_ident(relname) AS table
+    pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(c.relname) AS table,
+    ui.indrelid IS NOT NULL AS unique_index,
+    ua.attrelid IS NOT NULL AS unalterable
 FROM
-    pg_class c,
-    pg_namespace n,
-    pg_index i
+    pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON (c.relnamespace = n.oid)
+    LEFT JOIN (SELECT DISTINCT indrelid FROM pg_catalog.pg_index WHERE indisunique) ui ON (ui.indrelid = c.oid)
+    LEFT JOIN (SELECT DISTINCT attrelid
+               FROM pg_catalog.pg_attribute
+               WHERE attisdropped
+                   AND attnum >= 0
+                   AND (attlen, attbyval, attalign, attstorage) NOT IN
+                       (SELECT typlen, typbyval, typalign, typstorage
+                        FROM pg_catalog.pg_type
+                        WHERE typisdefined AND typtype='b')) ua ON (ua.attrelid = c.oid)
 WHERE
-  i.indrelid = c.oid
-  AND c.relnamespace = n.oid
-  AND i.indisunique
-  AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast',
-                        'pg_bitmapindex', 'pg_aoseg')
+    c.relkind = 'r'
+    AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast',
+                          'pg_bitmapindex', 'pg_aoseg')
+    AND (ui.indrelid IS NOT NULL OR ua.attrelid IS NOT NULL)
+"""
+
+# names of the distribution key columns of a table in key order, resolved in
+# the populate queries so they stream with the rows; takes the table oid and
+# attrnums expressions of the query as oid and attrnums
+dist_key_columns_sql = """array_to_string(ARRAY(
+        SELECT a.attname FROM pg_catalog.pg_attribute a, generate_series(1, array_upper(%(attrnums)s, 1)) AS k
+        WHERE a.attrelid = %(oid)s AND a.attnum = %(attrnums)s[k] ORDER BY k), ' , ')"""
+
+# user table sizes and scan counts summed over the segments in one pass per
+# database, kept in a temporary table both populate queries join by oid; each
+# segment stats its own files instead of a dispatch per table, and the master
+# alone does not see the scans of distributed tables
+relation_stats_table = 'gpexpand_relation_stats'
+relation_stats_sql = """
+SELECT oid AS relid, %s AS bytes, sum(pg_stat_get_numscans(oid)) AS scans
+FROM gp_dist_random('pg_class')
+WHERE relkind = 'r'
+    AND relstorage != 'x'
+    AND oid >= 16384
+GROUP BY oid
 """
 
 
@@ -529,7 +908,7 @@ class GpExpandStatus():
             cpCmd = RemoteCopy('gpexpand copying status file to master mirror',
                                self._status_standby_filename, self._master_mirror.getSegmentHostName(),
                                self._status_filename)
-            cpCmd.run(validateAfter=True)
+            journal.run(cpCmd, validateAfter=True)
 
     def set_status(self, status, status_info=None):
         """Sets the current status.  gpexpand status must be set in
@@ -551,6 +930,7 @@ class GpExpandStatus():
             self._sync_status_file()
         self._fp.write('%s:%s\n' % (status, status_info))
         self._fp.flush()
+        journal.event('status', status=status, info=status_info)
         self._status.append(status)
         self._status_info.append(status_info)
 
@@ -632,6 +1012,9 @@ class ExpansionError(Exception): pass
 class SegmentTemplateError(Exception): pass
 
 
+class OnlineRedistributionError(Exception): pass
+
+
 # -------------------------------------------------------------------------
 class SegmentTemplate:
     """Class for creating, distributing and deploying new segments to an
@@ -674,7 +1057,7 @@ class SegmentTemplate:
             hostnameCmd = Hostname('gpexpand associating hostnames with segments', ctxt=REMOTE, remoteHost=host)
             pool.addCommand(hostnameCmd)
 
-        pool.join()
+        journal.join(pool, 'gpexpand associating hostnames with segments')
 
         finished_cmds = pool.getCompletedItems()
 
@@ -726,7 +1109,7 @@ class SegmentTemplate:
         pgControlDataCmd = PgControlData('Validate stopped', self.masterDataDirectory)
         state = None
         try:
-            pgControlDataCmd.run(validateAfter=True)
+            journal.run(pgControlDataCmd, validateAfter=True)
         except Exception, e:
             raise SegmentTemplateError(e)
         state = pgControlDataCmd.get_value('Database cluster state')
@@ -765,7 +1148,7 @@ class SegmentTemplate:
             cpCmd = RemoteCopy('gpexpand distribute tar file to new hosts', self.schema_tar_file, host, self.segTarDir)
             self.pool.addCommand(cpCmd)
 
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand distribute tar file to new hosts')
         self.pool.check_results()
 
     def _configure_new_segments(self):
@@ -782,7 +1165,7 @@ class SegmentTemplate:
                                             ctxt=REMOTE, remoteHost=host)
             self.pool.addCommand(segCfgCmd)
 
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand configure new segments')
         self.pool.check_results()
 
         self.logger.info('Configuring new segments (mirror)')
@@ -795,7 +1178,7 @@ class SegmentTemplate:
                                             ctxt=REMOTE, remoteHost=host, validationOnly=True)
             self.pool.addCommand(segCfgCmd)
 
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand configure new segments')
         self.pool.check_results()
 
     def _get_transaction_filespace_dir(self, transaction_flat_file):
@@ -821,13 +1204,13 @@ class SegmentTemplate:
             'gpexpand copying postgresql.conf to %s:%s/postgresql.conf' % (self.srcSegHostname, self.srcSegDataDir),
             self.srcSegDataDir + '/postgresql.conf', localHostname,
             self.tempDir, ctxt=REMOTE, remoteHost=self.srcSegHostname)
-        cpCmd.run(validateAfter=True)
+        journal.run(cpCmd, validateAfter=True)
 
         self.logger.info('Copying pg_hba.conf from existing segment into template')
         cpCmd = RemoteCopy('gpexpand copy pg_hba.conf to %s:%s/pg_hba.conf' % (self.srcSegHostname, self.srcSegDataDir),
                            self.srcSegDataDir + '/pg_hba.conf', localHostname,
                            self.tempDir, ctxt=REMOTE, remoteHost=self.srcSegHostname)
-        cpCmd.run(validateAfter=True)
+        journal.run(cpCmd, validateAfter=True)
 
         # Copy the transaction directories into template
         pg_system_filespace_entries = GetFilespaceEntriesDict(GetFilespaceEntries(self.gparray,
@@ -846,36 +1229,36 @@ class SegmentTemplate:
                     src_dir = os.path.join(filespace_dir, directory)
 
                     mkCmd = MakeDirectory('gpexpand creating transaction directories in template', dst_dir)
-                    mkCmd.run(validateAfter=True)
+                    journal.run(mkCmd, validateAfter=True)
                     cpCmd = LocalDirCopy('gpexpand copying dir %s' % src_dir, src_dir, dst_dir)
-                    cpCmd.run(validateAfter=True)
+                    journal.run(cpCmd, validateAfter=True)
 
         # Don't need log files and gpperfmon files in template.
         rmCmd = RemoveDirectory('gpexpand remove gppermfon data from template',
                                 self.tempDir + '/gpperfmon/data')
-        rmCmd.run(validateAfter=True)
+        journal.run(rmCmd, validateAfter=True)
         rmCmd = RemoveDirectoryContents('gpexpand remove logs from template',
                                         self.tempDir + '/pg_log')
-        rmCmd.run(validateAfter=True)
+        journal.run(rmCmd, validateAfter=True)
 
         # other files not needed
         rmCmd = RemoveFile('gpexpand remove postmaster.opt from template',
                             self.tempDir + '/postmaster.opts')
-        rmCmd.run(validateAfter=True)
+        journal.run(rmCmd, validateAfter=True)
         rmCmd = RemoveFile('gpexpand remove postmaster.pid from template',
                             self.tempDir + '/postmaster.pid')
-        rmCmd.run(validateAfter=True)
+        journal.run(rmCmd, validateAfter=True)
         rmCmd = RemoveGlob('gpexpand remove gpexpand files from template',
                             self.tempDir + '/gpexpand.*')
-        rmCmd.run(validateAfter=True)
+        journal.run(rmCmd, validateAfter=True)
 
         # We dont need the flat files
         rmCmd = RemoveFile('gpexpand remove transaction flat file from template',
                             self.tempDir + '/' + GP_TRANSACTION_FILES_FILESPACE)
-        rmCmd.run(validateAfter=True)
+        journal.run(rmCmd, validateAfter=True)
         rmCmd = RemoveFile('gpexpand remove temporary flat file from template',
                             self.tempDir + '/' + GP_TEMPORARY_FILES_FILESPACE)
-        rmCmd.run(validateAfter=True)
+        journal.run(rmCmd, validateAfter=True)
 
         self.logger.info('Adding new segments into template pg_hba.conf')
         try:
@@ -905,16 +1288,16 @@ class SegmentTemplate:
         """Tars up the template files"""
         self.logger.info('Creating schema tar file')
         tarCmd = CreateTar('gpexpand tar segment template', self.tempDir, self.schema_tar_file)
-        tarCmd.run(validateAfter=True)
+        journal.run(tarCmd, validateAfter=True)
 
     @staticmethod
     def cleanup_build_segment_template(tarFile, tempDir):
         """Reverts the work done by build_segment_template.  Deletes the temp
         directory and local tar file"""
         rmCmd = RemoveDirectory('gpexpand remove temp dir: %s' % tempDir, tempDir)
-        rmCmd.run(validateAfter=True)
+        journal.run(rmCmd, validateAfter=True)
         rmCmd = RemoveFile('gpexpand remove segment template file', tarFile)
-        rmCmd.run(validateAfter=True)
+        journal.run(rmCmd, validateAfter=True)
 
     @staticmethod
     def cleanup_build_new_segments(pool, tarFile, gparray, hosts=None, removeDataDirs=False):
@@ -941,7 +1324,7 @@ class SegmentTemplate:
                     rmCmd = RemoveDirectory('gpexpand remove new segment data directory: %s:%s' % (hostname, datadir),
                                             datadir, ctxt=REMOTE, remoteHost=hostname)
                     pool.addCommand(rmCmd)
-        pool.join()
+        journal.join(pool, 'gpexpand remove new segment data directories')
         pool.check_results()
 
     def cleanup(self):
@@ -978,6 +1361,9 @@ class gpexpand:
         self.numworkers = parallel
         self.gparray = gparray
         self.unique_index_tables = {}
+        self.colocation_groups = {}
+        self.flagged_tables = None
+        self.host_probes = None
         self.conn = dbconn.connect(self.dburl, utility=True, encoding='UTF8', allowSystemTableMods='dml')
         self.old_segments = self.gparray.getSegDbList()
         if dburl.pgdb == 'template0' or dburl.pgdb == 'template1' or dburl.pgdb == 'postgres':
@@ -1001,6 +1387,14 @@ class gpexpand:
             self.tempDir = createTempDirectoryName(self.options.master_data_directory, "gpexpand")
         self.queue = None
         self.segTemplate = None
+        self.driver_id = None
+        self.catalog_maintenance = None
+        self.skew_verifier = None
+        self.estimates = {}
+        self.metrics = None
+        self.segment_movement = None
+        self.table_progress = None
+        self.heartbeat = None
         pass
 
     @staticmethod
@@ -1032,6 +1426,20 @@ class gpexpand:
 
         return gpexpand_db_status
 
+    @staticmethod
+    def get_cooperative_status(dburl):
+        """Gets gpexpand status from the gpexpand schema of a running cluster"""
+        conn = dbconn.connect(dburl, encoding='UTF8')
+        try:
+            cursor = dbconn.execSQL(conn, 'SELECT status FROM gpexpand.status ORDER BY updated DESC LIMIT 1')
+            if cursor.rowcount != 1:
+                raise ExpansionError('No expansion to take part in: gpexpand.status is empty')
+            return cursor.fetchone()[0]
+        except DatabaseError, ex:
+            raise ExpansionError('No expansion to take part in: %s' % str(ex).strip())
+        finally:
+            conn.close()
+
     @staticmethod
     def get_gpdb_in_state(state, options):
         runningStatus = chk_local_db_running(options.master_data_directory, options.pgport)
@@ -1103,26 +1511,15 @@ class gpexpand:
             db_list = catalog.getDatabaseList(status_conn)
             status_conn.close()
 
-            for db in db_list:
-                dbname = db[0]
-                if dbname in ['template0', 'template1', 'postgres', dburl.pgdb]:
-                    continue
-                logger.debug('Looking for gpexpand schema in %s' % dbname.decode('utf-8'))
-                test_url = copy.deepcopy(dburl)
-                test_url.pgdb = dbname
-                c = dbconn.connect(test_url, encoding='UTF8')
-                try:
-                    cursor = dbconn.execSQL(c, 'SELECT status FROM gpexpand.status ORDER BY updated DESC LIMIT 1')
-                except:
-                    # Not in here
-                    pass
-                else:
+            databases = [db[0] for db in db_list
+                         if db[0] not in ['template0', 'template1', 'postgres', dburl.pgdb]]
+            commands = run_preflight_checks(dburl, databases, [('gpexpand schema', gpexpand_status_exists_sql)],
+                                            False, 'Pre-flight gpexpand schema probe')
+            for cmd in commands:
+                if cmd.rows['gpexpand schema'][0][0] > 0:
                     raise ExpansionError("""gpexpand schema exists in database %s, not in %s.
 Set PGDATABASE or use the -D option to specify the correct database to use.""" % (
-                        dbname.decode('utf-8'), options.database))
-                finally:
-                    if c:
-                        c.close()
+                        cmd.dbname.decode('utf-8'), options.database))
 
         return gpexpand_db_status
 
@@ -1146,35 +1543,58 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
 
         return True
 
-    def validate_unalterable_tables(self):
-        conn = None
-        unalterable_tables = []
-
+    def validate_no_live_drivers(self):
+        """Returns False if --cooperative drivers are expanding tables, which a
+        non-cooperative run would take over from underneath them"""
+        conn = dbconn.connect(self.dburl, encoding='UTF8')
         try:
-            conn = dbconn.connect(self.dburl, utility=True, encoding='UTF8')
-            databases = catalog.getDatabaseList(conn)
+            sql = """SELECT count(*) FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n
+                     ON (c.relnamespace = n.oid) WHERE n.nspname = '%s' AND c.relname = '%s'""" % (
+                gpexpand_schema, drivers_table)
+            if dbconn.execSQLForSingleton(conn, sql) == 0:
+                return True
+            sql = """SELECT driver_id FROM %s.%s
+                     WHERE heartbeat > now() - interval '%d seconds'""" % (
+                gpexpand_schema, drivers_table, DRIVER_HEARTBEAT_TIMEOUT)
+            live_drivers = [row[0] for row in dbconn.execSQL(conn, sql)]
+        finally:
             conn.close()
 
-            tempurl = copy.deepcopy(self.dburl)
-            for db in databases:
-                if db[0] == 'template0':
-                    continue
-                self.logger.info('Checking database %s for unalterable tables...' % db[0].decode('utf-8'))
-                tempurl.pgdb = db[0]
-                conn = dbconn.connect(tempurl, utility=True, encoding='UTF8')
-                cursor = dbconn.execSQL(conn, unalterable_table_sql)
-                for row in cursor:
-                    unalterable_tables.append(row)
-                cursor.close()
-                conn.close()
+        if live_drivers:
+            self.logger.error('Cooperative gpexpand drivers are running (%s).' % ', '.join(live_drivers))
+            self.logger.error('Stop them or rerun gpexpand with --cooperative.')
+            return False
+        return True
+
+    def get_flagged_tables(self):
+        """Returns [(dbname, fq_name, unique_index, unalterable)] of the tables
+        flagged by flagged_tables_sql in all the databases, read once per run
+        with one utility connection and catalog scan per database"""
+        if self.flagged_tables is not None:
+            return self.flagged_tables
+
+        conn = dbconn.connect(self.dburl, utility=True, encoding='UTF8')
+        databases = [db[0] for db in catalog.getDatabaseList(conn) if db[0] != 'template0']
+        conn.close()
 
+        self.logger.info('Checking %d databases for unalterable tables and unique indexes...' % len(databases))
+        commands = run_preflight_checks(self.dburl, databases, [('flagged tables', flagged_tables_sql)],
+                                        True, 'Pre-flight catalog checks')
+        self.flagged_tables = [(cmd.dbname,) + tuple(row) for cmd in commands for row in cmd.rows['flagged tables']]
+        return self.flagged_tables
+
+    def validate_unalterable_tables(self):
+        try:
+            flagged_tables = self.get_flagged_tables()
         except DatabaseError, ex:
             if self.options.verbose:
                 logger.exception(ex)
             logger.error('Failed to check for unalterable tables.')
-            if conn: conn.close()
             raise ex
 
+        unalterable_tables = [(dbname, fq_name) for (dbname, fq_name, unique_index, unalterable) in flagged_tables
+                              if unalterable]
+
         if len(unalterable_tables) > 0:
             self.logger.error('The following tables cannot be altered because they contain')
             self.logger.error('dropped columns of user defined types:')
@@ -1190,36 +1610,19 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
         """ Checks if there are tables with unique indexes.
         Returns true if unique indexes exist"""
 
-        conn = None
-        has_unique_indexes = False
-
         try:
-            conn = dbconn.connect(self.dburl, utility=True, encoding='UTF8')
-            databases = catalog.getDatabaseList(conn)
-            conn.close()
-
-            tempurl = copy.deepcopy(self.dburl)
-            for db in databases:
-                if db[0] == 'template0':
-                    continue
-                self.logger.info('Checking database %s for tables with unique indexes...' % db[0].decode('utf-8'))
-                tempurl.pgdb = db[0]
-                conn = dbconn.connect(tempurl, utility=True, encoding='UTF8')
-                cursor = dbconn.execSQL(conn, has_unique_index_sql)
-                for row in cursor:
-                    has_unique_indexes = True
-                    self.unique_index_tables[row[0]] = True
-                cursor.close()
-                conn.close()
-
+            flagged_tables = self.get_flagged_tables()
         except DatabaseError, ex:
             if self.options.verbose:
                 logger.exception(ex)
             logger.error('Failed to check for unique indexes.')
-            if conn: conn.close()
             raise ex
 
-        return has_unique_indexes
+        for (dbname, fq_name, unique_index, unalterable) in flagged_tables:
+            if unique_index:
+                self.unique_index_tables['%s.%s' % (dbname, fq_name)] = True
+
+        return len(self.unique_index_tables) > 0
 
     def rollback(self, dburl):
         """Rolls back and expansion setup that didn't successfully complete"""
@@ -1387,7 +1790,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
         f = None
         try:
             existsCmd = FileDirExists(name="gpexpand see if .fs file exists", directory=fsInputFilename)
-            existsCmd.run(validateAfter=True)
+            journal.run(existsCmd, validateAfter=True)
             exists = existsCmd.filedir_exists()
             if exists == False and len(self.gparray.getFilespaces(includeSystemFilespace=False)) != 0:
                 raise ExpansionError("Expecting filespaces input file: " + fsInputFilename)
@@ -1522,7 +1925,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
 
             self.pool.addCommand(cpCmd)
 
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand back up pg_hba.conf file on original segments')
 
         try:
             self.pool.check_results()
@@ -1543,7 +1946,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
 
             self.pool.addCommand(cpCmd)
 
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand copy new pg_hba.conf file to original segments')
 
         try:
             self.pool.check_results()
@@ -1590,7 +1993,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
 
             self.pool.addCommand(cpCmd)
 
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand restore of pg_hba.conf file on original segments')
 
         try:
             self.pool.check_results()
@@ -1609,7 +2012,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
                                             ctxt=REMOTE, remoteHost=host)
             self.pool.addCommand(segCfgCmd)
 
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand configure original segments')
 
         try:
             self.pool.check_results()
@@ -1646,7 +2049,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
 
         self.logger.info('Starting Greenplum Database in restricted mode')
         startCmd = GpStart('gpexpand update master start database restricted mode', restricted=True, verbose=True)
-        startCmd.run(validateAfter=True)
+        journal.run(startCmd, validateAfter=True)
 
         # Put expansion segment primaries in change tracking
         for seg in self.gparray.getExpansionSegDbList():
@@ -1681,7 +2084,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
         self.logger.info('Stopping database')
         stopCmd = GpStop('gpexpand update master stop database', verbose=True, ctxt=LOCAL, force=True)
         # We do not check the results of GpStop becuase we will get errors for all the new segments.
-        stopCmd.run(validateAfter=False)
+        journal.run(stopCmd, validateAfter=False)
 
         self.statusLogger.set_status('UPDATE_CATALOG_DONE')
 
@@ -1724,7 +2127,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
                                      , remoteHost=seg.getSegmentHostName()
                                      )
             self.pool.addCommand(prepCmd)
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand prepare filespaces on new segments')
         self.pool.check_results()
 
     # --------------------------------------------------------------------------
@@ -1740,7 +2143,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
         self.logger.info('Starting master in utility mode')
 
         startCmd = GpStart('gpexpand update master start database master only', masterOnly=True)
-        startCmd.run(validateAfter=True)
+        journal.run(startCmd, validateAfter=True)
 
         conn = dbconn.connect(self.dburl, utility=True, encoding='UTF8')
         databases = catalog.getDatabaseList(conn)
@@ -1770,7 +2173,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
                 , noWait=False
                 , timeout=SEGMENT_TIMEOUT_DEFAULT)
             self.pool.addCommand(segStartCmd)
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand start new segments')
         self.pool.check_results()
 
         """
@@ -1799,7 +2202,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
                                                          , sqlCommandList=statements
                                                          )
                 self.pool.addCommand(execSQLCmd)
-                self.pool.join()
+                journal.join(self.pool, 'gpexpand segment cleanup commands')
                 ### need to fix self.pool.check_results(). Call getCompletedItems to clear the queue for now.
                 self.pool.check_results()
                 self.pool.getCompletedItems()
@@ -1819,12 +2222,12 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
                 , remoteHost=seg.getSegmentHostName()
             )
             self.pool.addCommand(segStopCmd)
-        self.pool.join()
+        journal.join(self.pool, 'gpexpand stop new segments')
         self.pool.check_results()
 
         self.logger.info('Starting Greenplum Database in restricted mode')
         startCmd = GpStart('gpexpand update master start database restricted', restricted=True, verbose=True)
-        startCmd.run(validateAfter=True)
+        journal.run(startCmd, validateAfter=True)
 
         # Need to restore the connection used by the expansion
         self.conn = dbconn.connect(self.dburl, encoding='UTF8')
@@ -1911,7 +2314,7 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
         if self.gparray.get_mirroring_enabled() == True:
             self.logger.info('Starting new mirror segment synchronization')
             cmd = GpRecoverSeg(name="gpexpand syncing mirrors", options="-a -F")
-            cmd.run(validateAfter=True)
+            journal.run(cmd, validateAfter=True)
 
     def start_prepare(self):
         """Inserts into gpexpand.status that expansion preparation has started."""
@@ -1932,12 +2335,22 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
         dbconn.execSQL(self.conn, create_schema_sql)
         dbconn.execSQL(self.conn, status_table_sql)
         dbconn.execSQL(self.conn, status_detail_table_sql)
+        dbconn.execSQL(self.conn, drivers_table_sql)
+        dbconn.execSQL(self.conn, table_skew_table_sql)
+        dbconn.execSQL(self.conn, table_estimates_table_sql)
+        dbconn.execSQL(self.conn, progress_counters_table_sql)
+        dbconn.execSQL(self.conn, segment_movement_table_sql)
+        dbconn.execSQL(self.conn, table_progress_table_sql)
 
         # views
         if not self.options.simple_progress:
             dbconn.execSQL(self.conn, progress_view_sql)
         else:
             dbconn.execSQL(self.conn, progress_view_simple_sql)
+        dbconn.execSQL(self.conn, partition_progress_view_sql)
+        dbconn.execSQL(self.conn, segment_progress_view_sql)
+        dbconn.execSQL(self.conn, host_progress_view_sql)
+        dbconn.execSQL(self.conn, skewed_tables_view_sql)
 
         self.conn.commit()
 
@@ -1956,18 +2369,14 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
 
         dbconn.execSQL(self.conn, statusSQL)
 
-        db_list = catalog.getDatabaseList(self.conn)
+        db_list = [db[0] for db in catalog.getDatabaseList(self.conn) if db[0] != 'template0']
+        self._populate_databases(db_list)
 
-        for db in db_list:
-            dbname = db[0]
-            if dbname == 'template0':
-                continue
-            self.logger.info('Populating %s.%s with data from database %s' % (
-                gpexpand_schema, status_detail_table, dbname.decode('utf-8')))
-            self._populate_regular_tables(dbname)
-            self._populate_partitioned_tables(dbname)
-            inject_fault('gpexpand MPP-14620 fault injection')
-            self._update_distribution_policy(dbname)
+        self.logger.info('Indexing %s.%s' % (gpexpand_schema, status_detail_table))
+        for sql in status_detail_index_sql:
+            dbconn.execSQL(self.conn, sql)
+        dbconn.execSQL(self.conn, 'ANALYZE %s.%s' % (gpexpand_schema, status_detail_table))
+        self._rebuild_progress_counters(reset_window=True)
 
         nowStr = datetime.datetime.now()
         statusSQL = "INSERT INTO %s.%s VALUES ( 'SETUP DONE', '%s' ) " % (gpexpand_schema, status_table, nowStr)
@@ -1987,162 +2396,216 @@ Set PGDATABASE or use the -D option to specify the correct database to use.""" %
         self.logger.info('Stopping Greenplum Database')
         GpStop.local('gpexpand setup complete', fast=True)
 
-    def _populate_regular_tables(self, dbname):
+    def _status_copy_connection(self):
+        """The PyGreSQL connection underneath the pgdb status connection.  pgdb
+        has no COPY FROM STDIN, and copying through the connection underneath
+        keeps the load in the transaction of the status connection."""
+        return self.conn._cnx
+
+    def _populate_databases(self, db_list):
+        """Scans the databases on up to PREPARE_WORKERS workers, each in its own
+        connections, and funnels their status_detail rows into one COPY ... FROM
+        STDIN on the status connection, inside the prepare transaction."""
+        rows = Queue.Queue(maxsize=PREPARE_WORKERS * 2)
+        aborted = threading.Event()
+        errors = []
+
+        status_cnx = self._status_copy_connection()
+        copySQL = """COPY %s.%s FROM STDIN NULL AS 'NULL'""" % (gpexpand_schema, status_detail_table)
+        self.logger.debug(copySQL)
+        status_cnx.query(copySQL)
+
+        pool = WorkerPool(numWorkers=max(1, min(PREPARE_WORKERS, len(db_list))))
+        try:
+            for dbname in db_list:
+                pool.addCommand(PopulateDatabaseCommand('gpexpand populate %s' % dbname, self, dbname,
+                                                        rows, aborted))
+            pending = len(db_list)
+            # once aborted the workers stop queueing, so stop waiting for them
+            while pending and not aborted.is_set():
+                item = rows.get()
+                if item[0] == 'done':
+                    pending -= 1
+                    if item[2] is not None:
+                        errors.append((item[1], item[2]))
+                        aborted.set()
+                else:
+                    try:
+                        status_cnx.putline(item[1])
+                    except Exception, e:
+                        errors.append((None, e))
+                        aborted.set()
+        finally:
+            # workers blocked on the full queue give up once aborted is set
+            aborted.set()
+            try:
+                status_cnx.putline('\\.\n')
+                status_cnx.endcopy()
+            finally:
+                pool.haltWork()
+                pool.joinWorkers()
+
+        if errors:
+            (dbname, e) = errors[0]
+            if dbname is None:
+                raise ExpansionError('Could not load %s.%s: %s' % (gpexpand_schema, status_detail_table, e))
+            raise ExpansionError('Could not populate %s.%s from database %s: %s' % (
+                gpexpand_schema, status_detail_table, dbname.decode('utf-8'), e))
+
+    def _load_relation_stats(self, table_conn):
+        """Sums the sizes and scan counts of the database's tables over the
+        segments once, into a temporary table both populate queries join"""
+        bytes_str = "0" if self.options.simple_progress else "sum(pg_relation_size(oid))"
+        sql = 'CREATE TEMP TABLE %s AS %s DISTRIBUTED BY (relid)' % (relation_stats_table,
+                                                                    relation_stats_sql % bytes_str)
+        self.logger.debug(sql)
+        dbconn.execSQL(table_conn, sql)
+        table_conn.commit()
+
+    def _populate_regular_tables(self, table_conn, dbname, sink):
         """ we don't do 3.2+ style partitioned tables here, but we do
             all other table types.
         """
 
-        src_bytes_str = "0" if self.options.simple_progress else "pg_relation_size(quote_ident(n.nspname) || '.' || quote_ident(c.relname))"
+        stats_join = "LEFT JOIN %s st ON (c.oid = st.relid)" % relation_stats_table
         sql = """SELECT
     n.nspname || '.' || c.relname as fq_name,
     n.oid as schemaoid,
     c.oid as tableoid,
     p.attrnums as distribution_policy,
     now() as last_updated,
-    %s
+    coalesce(st.bytes, 0),
+    coalesce(st.scans, 0) as scan_count,
+    NULL::text as partition_root,
+    %s as distribution_columns
 FROM
             pg_class c
     JOIN pg_namespace n ON (c.relnamespace=n.oid)
     JOIN pg_catalog.gp_distribution_policy p on (c.oid = p.localoid)
     LEFT JOIN pg_partition pp on (c.oid=pp.parrelid)
     LEFT JOIN pg_partition_rule pr on (c.oid=pr.parchildrelid)
+    %s
 WHERE
     pp.parrelid is NULL
     AND pr.parchildrelid is NULL
     AND n.nspname != 'gpexpand'
     AND n.nspname != 'pg_bitmapindex'
-    AND c.relstorage != 'x';
-
-                  """ % (src_bytes_str)
-        self.logger.debug(sql)
-        table_conn = self.connect_database(dbname)
-        curs = dbconn.execSQL(table_conn, sql)
-        rows = curs.fetchall()
-        try:
-            sql_file = os.path.abspath('./%s.dat' % status_detail_table)
-            self.logger.debug('status_detail data file: %s' % sql_file)
-            fp = open(sql_file, 'w')
-            for row in rows:
-                fqname = row[0]
-                schema_oid = row[1]
-                table_oid = row[2]
-                if row[3]:
-                    self.logger.debug("dist policy raw: %s " % row[3].decode('utf-8'))
-                else:
-                    self.logger.debug("dist policy raw: NULL")
-                dist_policy = row[3]
-                (policy_name, policy_oids) = self.form_dist_policy_name(table_conn, row[3], table_oid)
-                rel_bytes = int(row[5])
-
-                if dist_policy is None:
-                    dist_policy = 'NULL'
-
-                full_name = '%s.%s' % (dbname, fqname)
-                rank = 1 if self.unique_index_tables.has_key(full_name) else 2
-
-                fp.write("""%s\t%s\t%s\t%s\t%s\t%s\t%s\tNULL\t%d\t%s\tNULL\tNULL\t%d\n""" % (
-                    dbname, fqname, schema_oid, table_oid,
-                    dist_policy, policy_name, policy_oids,
-                    rank, undone_status, rel_bytes))
-        except Exception, e:
-            raise ExpansionError(e)
-        finally:
-            if fp: fp.close()
-
-        try:
-            copySQL = """COPY %s.%s FROM '%s' NULL AS 'NULL'""" % (gpexpand_schema, status_detail_table, sql_file)
-
-            self.logger.debug(copySQL)
-            dbconn.execSQL(self.conn, copySQL)
-        except Exception, e:
-            raise ExpansionError(e)
-        finally:
-            os.unlink(sql_file)
-
-        table_conn.commit()
-        table_conn.close()
-
-    def _populate_partitioned_tables(self, dbname):
-        """population of status_detail for partitioned tables. """
-        src_bytes_str = "0" if self.options.simple_progress else "pg_relation_size(quote_ident(p.partitionschemaname) || '.' || quote_ident(p.partitiontablename))"
+    AND c.relstorage != 'x'
+                  """ % (dist_key_columns_sql % {'oid': 'c.oid', 'attrnums': 'p.attrnums'}, stats_join)
+        self._stream_status_detail(table_conn, dbname, sql, sink)
+
+    def _populate_partitioned_tables(self, table_conn, dbname, sink):
+        """population of status_detail for partitioned tables.  The leaves are
+        found by oid through pg_partition/pg_partition_rule, at the deepest
+        level of each root, rather than by name through pg_partitions."""
+        stats_join = "LEFT JOIN %s st ON (d.localoid = st.relid)" % relation_stats_table
         sql = """
 SELECT
-    p.partitionschemaname || '.' || p.partitiontablename as fq_name,
+    n2.nspname || '.' || c2.relname as fq_name,
     n.oid as schemaoid,
     c2.oid as tableoid,
     d.attrnums as distributed_policy,
     now() as last_updated,
-    %s,
-    partitiontype,partitionlevel,partitionrank,partitionposition,
-    partitionrangestart
+    coalesce(st.bytes, 0),
+    coalesce(st.scans, 0) as scan_count,
+    n.nspname || '.' || c.relname as partition_root,
+    %s as distribution_columns
 FROM
-    pg_partitions p,
-    pg_class c,
-    pg_class c2,
-    pg_namespace n,
-    pg_namespace n2,
-    gp_distribution_policy d
+    (SELECT parrelid, max(parlevel) AS leaflevel
+     FROM pg_partition
+     WHERE NOT paristemplate
+     GROUP BY parrelid) lv
+    JOIN pg_partition pp ON (pp.parrelid = lv.parrelid AND pp.parlevel = lv.leaflevel AND NOT pp.paristemplate)
+    JOIN pg_partition_rule pr ON (pr.paroid = pp.oid)
+    JOIN pg_class c ON (c.oid = pp.parrelid)
+    JOIN pg_namespace n ON (c.relnamespace = n.oid)
+    JOIN pg_class c2 ON (c2.oid = pr.parchildrelid)
+    JOIN pg_namespace n2 ON (c2.relnamespace = n2.oid)
+    JOIN gp_distribution_policy d ON (d.localoid = c2.oid)
+    %s
 WHERE
-    quote_ident(p.tablename) = quote_ident(c.relname)
-    AND    d.localoid = c2.oid
-    AND quote_ident(p.schemaname) = quote_ident(n.nspname)
-    AND c.relnamespace = n.oid
-    AND p.partitionlevel = (select max(parlevel) FROM pg_partition WHERE parrelid = c.oid)
-    AND quote_ident(p.partitionschemaname) = quote_ident(n2.nspname)
-    AND quote_ident(p.partitiontablename) = quote_ident(c2.relname)
-    AND c2.relnamespace = n2.oid
-    AND c2.relstorage != 'x'
-ORDER BY tablename, c2.oid desc;
-                  """ % (src_bytes_str)
+    c2.relstorage != 'x'
+ORDER BY c.relname, c2.oid desc
+                  """ % (dist_key_columns_sql % {'oid': 'c2.oid', 'attrnums': 'd.attrnums'}, stats_join)
+        self._stream_status_detail(table_conn, dbname, sql, sink)
+
+    def _stream_status_detail(self, table_conn, dbname, sql, sink):
+        """Streams the rows of a populate query through a server-side cursor,
+        POPULATE_FETCH_ROWS at a time, handing each chunk of COPY text to sink
+        so memory use does not grow with the number of tables."""
         self.logger.debug(sql)
-        table_conn = self.connect_database(dbname)
-        curs = dbconn.execSQL(table_conn, sql)
-        rows = curs.fetchall()
-
+        colocation_groups = self._get_colocation_groups(table_conn, dbname)
+        dbconn.execSQL(table_conn, 'DECLARE gpexpand_populate NO SCROLL CURSOR FOR %s' % sql)
         try:
-            sql_file = os.path.abspath('./%s.dat' % status_detail_table)
-            self.logger.debug('status_detail data file: %s' % sql_file)
-            fp = open(sql_file, 'w')
-
-            for row in rows:
-                fqname = row[0]
-                schema_oid = row[1]
-                table_oid = row[2]
-                if row[3]:
-                    self.logger.debug("dist policy raw: %s " % row[3])
-                else:
-                    self.logger.debug("dist policy raw: NULL")
-                dist_policy = row[3]
-                (policy_name, policy_oids) = self.form_dist_policy_name(table_conn, row[3], table_oid)
-                rel_bytes = int(row[5])
-
-                if dist_policy is None:
-                    dist_policy = 'NULL'
+            while True:
+                rows = dbconn.execSQL(table_conn, 'FETCH %d FROM gpexpand_populate' % POPULATE_FETCH_ROWS).fetchall()
+                if not rows:
+                    break
+                lines = []
+                for row in rows:
+                    fqname = row[0]
+                    schema_oid = row[1]
+                    table_oid = row[2]
+                    if row[3]:
+                        self.logger.debug("dist policy raw: %s " % row[3])
+                    else:
+                        self.logger.debug("dist policy raw: NULL")
+                    dist_policy = row[3]
+                    (policy_name, policy_oids) = self.form_dist_policy_name(row[8], row[3], table_oid)
+                    rel_bytes = int(row[5])
+                    scan_count = int(row[6])
+                    colocation_group = colocation_groups.get(table_oid, 'NULL')
+                    partition_root = row[7] or 'NULL'
+
+                    if dist_policy is None:
+                        dist_policy = 'NULL'
+
+                    full_name = '%s.%s' % (dbname, fqname)
+                    rank = 1 if self.unique_index_tables.has_key(full_name) else 2
+
+                    lines.append("""%s\t%s\t%s\t%s\t%s\t%s\t%s\tNULL\t%d\t%s\tNULL\tNULL\t%d\tNULL\tNULL\t%d\t%s\t%s\n""" % (
+                        dbname, fqname, schema_oid, table_oid,
+                        dist_policy, policy_name, policy_oids,
+                        rank, undone_status, rel_bytes, scan_count, colocation_group,
+                        partition_root))
+                sink(''.join(lines))
+        except Exception, e:
+            raise ExpansionError(e)
+        finally:
+            dbconn.execSQL(table_conn, 'CLOSE gpexpand_populate')
+            table_conn.commit()
 
-                full_name = '%s.%s' % (dbname, fqname)
-                rank = 1 if self.unique_index_tables.has_key(full_name) else 2
+    def _get_colocation_groups(self, conn, dbname):
+        """Groups the tables of a database that reference each other with a foreign
+        key on their distribution keys, as those are joined co-located.  Returns a
+        dict of table oid -> group name; must run before the policies are nulled."""
+        if dbname in self.colocation_groups:
+            return self.colocation_groups[dbname]
 
-                fp.write("""%s\t%s\t%s\t%s\t%s\t%s\t%s\tNULL\t%d\t%s\tNULL\tNULL\t%d\n""" % (
-                    dbname, fqname, schema_oid, table_oid,
-                    dist_policy, policy_name, policy_oids,
-                    rank, undone_status, rel_bytes))
-        except Exception:
-            raise
-        finally:
-            if fp: fp.close()
+        sql = """
+SELECT c.conrelid, c.confrelid
+FROM pg_catalog.pg_constraint c
+    JOIN pg_catalog.gp_distribution_policy pa ON (pa.localoid = c.conrelid)
+    JOIN pg_catalog.gp_distribution_policy pb ON (pb.localoid = c.confrelid)
+WHERE c.contype = 'f'
+    AND c.conrelid != c.confrelid
+    AND pa.attrnums = c.conkey
+    AND pb.attrnums = c.confkey"""
+        self.logger.debug(sql)
+        parent = {}
 
-        try:
-            copySQL = """COPY %s.%s FROM '%s' NULL AS 'NULL'""" % (gpexpand_schema, status_detail_table, sql_file)
+        def find(oid):
+            while parent.setdefault(oid, oid) != oid:
+                oid = parent[oid]
+            return oid
 
-            self.logger.debug(copySQL)
-            dbconn.execSQL(self.conn, copySQL)
-        except Exception, e:
-            raise ExpansionError(e)
-        finally:
-            os.unlink(sql_file)
+        for row in dbconn.execSQL(conn, sql):
+            (a, b) = (find(row[0]), find(row[1]))
+            parent[max(a, b)] = min(a, b)
 
-        table_conn.commit()
-        table_conn.close()
+        groups = dict((oid, '%s:%s' % (dbname, find(oid))) for oid in parent)
+        self.colocation_groups[dbname] = groups
+        return groups
 
     def _update_distribution_policy(self, dbname):
         """ NULL out the distribution policy for both
@@ -2191,40 +2654,38 @@ UPDATE gp_distribution_policy
         table_conn.commit()
         table_conn.close()
 
-    def form_dist_policy_name(self, conn, rs_val, table_oid):
+    def form_dist_policy_name(self, dist_names, rs_val, table_oid):
         if rs_val is None:
             return (None, None)
         rs_val = rs_val.lstrip('{').rstrip('}').strip()
 
-        namedict = {}
-        oiddict = {}
-        sql = "select attnum, attname, attrelid from pg_attribute where attrelid =  %s and attnum > 0" % table_oid
-        cursor = dbconn.execSQL(conn, sql)
-        for row in cursor:
-            namedict[row[0]] = row[1]
-            oiddict[row[0]] = row[2]
+        if rs_val == "":
+            return ('', '')
 
-        name_list = []
-        oid_list = []
-
-        if rs_val != "":
-            rs_list = rs_val.split(',')
-
-            for colnum in rs_list:
-                name_list.append(namedict[int(colnum)])
-                oid_list.append(str(oiddict[int(colnum)]))
-
-        return (' , '.join(name_list), ' , '.join(oid_list))
+        # the names come from the populate query, in distribution key order
+        return (dist_names, ' , '.join([str(table_oid)] * len(rs_val.split(','))))
 
     def perform_expansion(self):
         """Performs the actual table re-organiations"""
+        if self.options.cooperative:
+            return self.perform_cooperative_expansion()
+
         expansionStart = datetime.datetime.now()
 
         # setup a threadpool
         self.queue = WorkerPool(numWorkers=self.numworkers)
+        self.catalog_maintenance = CatalogMaintenance(self.logger, self.dburl,
+                                                      self.options.catalog_vacuum_interval)
+        self.skew_verifier = self._start_skew_verifier()
+        self.metrics = self._start_metrics()
 
         # go through and reset any "IN PROGRESS" tables
         self.conn = dbconn.connect(self.dburl, encoding='UTF8')
+        self._ensure_table(drivers_table, drivers_table_sql)
+        self._ensure_history()
+        self.segment_movement = self._start_segment_movement('%s:%d' % (getLocalHostname(), os.getpid()))
+        self.table_progress = self._start_table_progress(self.segment_movement.driver)
+
         sql = "INSERT INTO %s.%s VALUES ( 'EXPANSION STARTED', '%s' ) " % (
             gpexpand_schema, status_table, expansionStart)
         cursor = dbconn.execSQL(self.conn, sql)
@@ -2234,16 +2695,36 @@ UPDATE gp_distribution_policy
         cursor = dbconn.execSQL(self.conn, sql)
         self.conn.commit()
 
-        # read schema and queue up commands
-        sql = "SELECT * FROM %s.%s WHERE status = 'NOT STARTED' ORDER BY rank" % (gpexpand_schema, status_detail_table)
+        self._apply_colocation_hints()
+        self._record_estimates()
+        self._rebuild_progress_counters(reset_window=True)
+
+        # read schema and queue up commands, holding frequently scanned
+        # tables back for the quiet hours if asked to
+        hot_threshold = self._hot_scan_threshold() if self.options.quiet_window else None
+        deferred = []
+        sql = "SELECT %s FROM %s.%s WHERE status = 'NOT STARTED' ORDER BY %s" % (
+            status_detail_columns, gpexpand_schema, status_detail_table, self._queue_order())
         cursor = dbconn.execSQL(self.conn, sql)
+        tables = [ExpandTable(options=self.options, row=row) for row in cursor]
+        for tbl in tables:
+            tbl.predicted_seconds = self.estimates.get((tbl.dbname, tbl.table_oid), 0.0)
 
-        for row in cursor:
-            self.logger.debug(row)
+        for tbl in self._group_back_to_back(tables):
+            self.logger.debug(tbl.fq_name)
             name = "name"
-            tbl = ExpandTable(options=self.options, row=row)
-            cmd = ExpandCommand(name=name, status_url=self.dburl, table=tbl, options=self.options)
-            self.queue.addCommand(cmd)
+            cmd = ExpandCommand(name=name, status_url=self.dburl, table=tbl, options=self.options,
+                                catalog_maintenance=self.catalog_maintenance,
+                                skew_verifier=self.skew_verifier, metrics=self.metrics,
+                                segment_movement=self.segment_movement, table_progress=self.table_progress)
+            if hot_threshold is not None and (tbl.scan_count or 0) > hot_threshold:
+                deferred.append(cmd)
+            else:
+                self.queue.addCommand(cmd)
+
+        if deferred:
+            self.logger.info('%d frequently scanned tables will be expanded during quiet hours %s' % (
+                len(deferred), self.options.quiet_hours))
 
         table_expand_error = False
 
@@ -2253,12 +2734,19 @@ UPDATE gp_distribution_policy
             stopTime = self.options.end
 
         # wait till done.
-        while not self.queue.isDone():
+        while not self.queue.isDone() or deferred:
             logger.debug(
                 "woke up.  queue: %d finished %d  " % (self.queue.num_assigned, self.queue.completed_queue.qsize()))
             if stopTime and datetime.datetime.now() >= stopTime:
                 stoppedEarly = True
                 break
+            if deferred and in_quiet_hours(self.options.quiet_window):
+                pending = self.queue.num_assigned - self.queue.completed_queue.qsize()
+                while deferred and pending < self.numworkers:
+                    self.queue.addCommand(deferred.pop(0))
+                    pending += 1
+            self.catalog_maintenance.vacuum_churned()
+            self._report_progress(len(deferred))
             time.sleep(5)
 
         expansionStopped = datetime.datetime.now()
@@ -2267,6 +2755,14 @@ UPDATE gp_distribution_policy
         self.pool.joinWorkers()
         self.queue.haltWork()
         self.queue.joinWorkers()
+        if self.skew_verifier:
+            self.skew_verifier.finish()
+        self._report_progress()
+        if self.table_progress:
+            self.table_progress.stop()
+        if self.metrics:
+            self.metrics.stop()
+        timeline.close()
 
         # Doing this after the halt and join workers guarantees that no new completed items can be added
         # while we're doing a check
@@ -2305,6 +2801,406 @@ UPDATE gp_distribution_policy
             self.conn.commit()
             logger.info("EXPANSION COMPLETED SUCCESSFULLY")
 
+    def _ensure_table(self, table, create_sql, schema=gpexpand_schema):
+        """Creates a gpexpand table if the schema was set up without it"""
+        sql = """SELECT count(*) FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n
+                 ON (c.relnamespace = n.oid) WHERE n.nspname = '%s' AND c.relname = '%s'""" % (
+            schema, table)
+        if dbconn.execSQLForSingleton(self.conn, sql) == 0:
+            dbconn.execSQL(self.conn, create_sql)
+            self.conn.commit()
+
+    def _ensure_history(self):
+        """Creates the throughput history on the first expansion of this cluster"""
+        sql = "SELECT count(*) FROM pg_catalog.pg_namespace WHERE nspname = '%s'" % history_schema
+        if dbconn.execSQLForSingleton(self.conn, sql) == 0:
+            dbconn.execSQL(self.conn, 'CREATE SCHEMA %s' % history_schema)
+            self.conn.commit()
+        self._ensure_table(table_history_table, table_history_table_sql, history_schema)
+
+    def _record_estimates(self):
+        """Stores the per-table predictions of the history model for the
+        expansion_progress ETA.  Each is the table's share of the wall-clock
+        time, its predicted duration divided by the number of workers."""
+        self._ensure_table(table_estimates_table, table_estimates_table_sql)
+        model = ThroughputModel.load(self.conn)
+        if not model.fits:
+            return
+        estimator = ExpansionEstimator(self.logger, self.dburl, self.options, model)
+        estimator.collect()
+
+        self.estimates = dict(((table['dbname'], table['table_oid']),
+                               model.predict(table, self.numworkers) / self.numworkers)
+                              for table in estimator.tables)
+        values = ["('%s', %s, %f)" % (dbname, table_oid, seconds)
+                  for ((dbname, table_oid), seconds) in self.estimates.items()]
+        dbconn.execSQL(self.conn, 'DELETE FROM %s.%s' % (gpexpand_schema, table_estimates_table))
+        for i in range(0, len(values), 1000):
+            dbconn.execSQL(self.conn, 'INSERT INTO %s.%s VALUES %s' % (
+                gpexpand_schema, table_estimates_table, ', '.join(values[i:i + 1000])))
+        self.conn.commit()
+        self.logger.info('Estimated time to completion from %d past tables: %s' % (
+            model.samples, datetime.timedelta(seconds=int(estimator.predict(self.numworkers)[0]))))
+
+    def _load_estimates(self):
+        """Reads the predictions stored by the driver that started the expansion"""
+        self._ensure_table(table_estimates_table, table_estimates_table_sql)
+        sql = "SELECT dbname, table_oid, predicted_seconds FROM %s.%s" % (gpexpand_schema, table_estimates_table)
+        self.estimates = dict(((row[0], row[1]), float(row[2])) for row in dbconn.execSQL(self.conn, sql))
+        self.conn.commit()
+
+    def _rebuild_progress_counters(self, reset_window):
+        """Recounts gpexpand.progress_counters from status_detail.  Only needed
+        after bulk status changes; the expand workers keep them up to date."""
+        self._ensure_table(progress_counters_table, progress_counters_table_sql)
+        self._ensure_table(table_estimates_table, table_estimates_table_sql)
+        dbconn.execSQL(self.conn, 'LOCK TABLE %s.%s IN EXCLUSIVE MODE' % (gpexpand_schema, progress_counters_table))
+        window = None
+        if not reset_window:
+            sql = """SELECT window_bytes, window_started, window_finished
+                     FROM %s.%s WHERE status = '%s'""" % (gpexpand_schema, progress_counters_table, done_status)
+            window = dbconn.execSQL(self.conn, sql).fetchone()
+        if not window:
+            window = (0, None, None)
+        window = ['NULL' if value is None else "'%s'" % value for value in window]
+
+        statuses = ' UNION ALL '.join("SELECT '%s'::text AS status" % status for status in
+                                      (undone_status, start_status, done_status, does_not_exist_status))
+        dbconn.execSQL(self.conn, 'DELETE FROM %s.%s' % (gpexpand_schema, progress_counters_table))
+        sql = """INSERT INTO %s.%s
+                 SELECT s.status, count(d.table_oid), coalesce(sum(d.source_bytes), 0),
+                        sum(e.predicted_seconds),
+                        CASE WHEN s.status = '%s' THEN %s::numeric END,
+                        CASE WHEN s.status = '%s' THEN %s::timestamp END,
+                        CASE WHEN s.status = '%s' THEN %s::timestamp END
+                 FROM (%s) s
+                 LEFT JOIN %s.%s d ON (d.status = s.status)
+                 LEFT JOIN %s.%s e ON (e.dbname = d.dbname AND e.table_oid = d.table_oid)
+                 GROUP BY s.status""" % (gpexpand_schema, progress_counters_table,
+                                         done_status, window[0], done_status, window[1],
+                                         done_status, window[2], statuses,
+                                         gpexpand_schema, status_detail_table,
+                                         gpexpand_schema, table_estimates_table)
+        dbconn.execSQL(self.conn, sql)
+        self.conn.commit()
+
+    def _register_driver(self):
+        """Registers this process in gpexpand.drivers.  Returns True if no other
+        driver was alive, in which case this driver starts the expansion."""
+        dbconn.execSQL(self.conn, 'LOCK TABLE %s.%s IN EXCLUSIVE MODE' % (gpexpand_schema, drivers_table))
+        sql = """SELECT count(*) FROM %s.%s
+                 WHERE heartbeat > now() - interval '%d seconds'""" % (
+            gpexpand_schema, drivers_table, DRIVER_HEARTBEAT_TIMEOUT)
+        first_driver = dbconn.execSQLForSingleton(self.conn, sql) == 0
+        sql = """INSERT INTO %s.%s VALUES ('%s', '%s', %d, now(), now())""" % (
+            gpexpand_schema, drivers_table, self.driver_id, getLocalHostname(), os.getpid())
+        dbconn.execSQL(self.conn, sql)
+        self.conn.commit()
+        return first_driver
+
+    def _reset_unclaimed_in_progress(self):
+        """Puts tables left IN PROGRESS by an interrupted non-cooperative run
+        back in the queue; no driver would ever claim or finish them"""
+        sql = """UPDATE %s.%s
+                 SET status = '%s', expansion_started = NULL, expansion_finished = NULL,
+                     expansion_phase = NULL
+                 WHERE claimed_by IS NULL AND status = '%s'""" % (
+            gpexpand_schema, status_detail_table, undone_status, start_status)
+        self.logger.debug(sql)
+        dbconn.execSQL(self.conn, sql)
+        self.conn.commit()
+
+    def _reclaim_dead_drivers(self):
+        """Hands the tables claimed by drivers that stopped heart-beating back to the queue"""
+        dbconn.execSQL(self.conn, 'LOCK TABLE %s.%s IN EXCLUSIVE MODE' % (gpexpand_schema, drivers_table))
+        sql = """SELECT driver_id FROM %s.%s
+                 WHERE heartbeat <= now() - interval '%d seconds'""" % (
+            gpexpand_schema, drivers_table, DRIVER_HEARTBEAT_TIMEOUT)
+        dead_drivers = [row[0] for row in dbconn.execSQL(self.conn, sql)]
+        if dead_drivers:
+            in_list = ', '.join("'%s'" % d for d in dead_drivers)
+            self.logger.warn('Reclaiming tables from unresponsive gpexpand drivers: %s' % ', '.join(dead_drivers))
+            sql = """UPDATE %s.%s
+                     SET status = '%s', expansion_started = NULL, expansion_finished = NULL,
+                         expansion_phase = NULL, claimed_by = NULL
+                     WHERE claimed_by IN (%s) AND status IN ('%s', '%s')""" % (
+                gpexpand_schema, status_detail_table, undone_status, in_list, undone_status, start_status)
+            dbconn.execSQL(self.conn, sql)
+            sql = "DELETE FROM %s.%s WHERE driver_id IN (%s)" % (gpexpand_schema, drivers_table, in_list)
+            dbconn.execSQL(self.conn, sql)
+            sql = "DELETE FROM %s.%s WHERE driver IN (%s)" % (gpexpand_schema, table_progress_table, in_list)
+            dbconn.execSQL(self.conn, sql)
+        self.conn.commit()
+        if dead_drivers:
+            self._rebuild_progress_counters(reset_window=False)
+
+    def estimate_expansion(self):
+        """Predicts the duration of perform_expansion from status_detail and a
+        short calibration on temporary copies of sample tables"""
+        estimator = ExpansionEstimator(self.logger, self.dburl, self.options, ThroughputModel.load(self.conn))
+        estimator.collect()
+        if not estimator.tables:
+            self.logger.info('No tables left to expand.')
+            return
+        estimator.calibrate()
+        estimator.report(self.numworkers)
+
+    def _start_segment_movement(self, driver):
+        self._ensure_table(segment_movement_table, segment_movement_table_sql)
+        return SegmentMovement(self.conn, driver)
+
+    def _start_table_progress(self, driver):
+        self._ensure_table(table_progress_table, table_progress_table_sql)
+        if not self.options.cooperative:
+            # left behind by an interrupted run
+            dbconn.execSQL(self.conn, 'DELETE FROM %s.%s' % (gpexpand_schema, table_progress_table))
+            self.conn.commit()
+        return TableProgressMonitor(self.logger, self.dburl, driver)
+
+    def _start_metrics(self):
+        if self.options.metrics_port is None and not self.options.metrics_file:
+            return None
+        return ExpansionMetrics(self.logger, self.options.metrics_port, self.options.metrics_file)
+
+    def _report_progress(self, deferred=0):
+        """Publishes the in-memory progress of the workers; called from the main loop"""
+        try:
+            self.segment_movement.flush(self.conn)
+        except Exception, e:
+            self.conn.rollback()
+            self.logger.debug('Could not record the segment data movement: %s' % e)
+        try:
+            self.table_progress.sample()
+            self.table_progress.flush(self.conn)
+        except Exception, e:
+            self.conn.rollback()
+            self.logger.debug('Could not measure the progress of the in-flight tables: %s' % e)
+        if not self.metrics:
+            return
+        pending = self.queue.num_assigned - self.queue.completed_queue.qsize() + deferred
+        try:
+            self.metrics.refresh(self.conn, pending, self.segment_movement.by_host(),
+                                 self.table_progress.current())
+        except Exception, e:
+            self.conn.rollback()
+            self.logger.debug('Could not refresh the expansion metrics: %s' % e)
+
+    def _start_skew_verifier(self):
+        if not self.options.verify_skew:
+            return None
+        self._ensure_table(table_skew_table, table_skew_table_sql)
+        return SkewVerifier(self.logger, self.dburl, min(self.numworkers, MAX_SKEW_VERIFIERS))
+
+    def _queue_order(self):
+        """ORDER BY list for the tables left to expand"""
+        if self.options.hot_first:
+            return 'rank, scan_count DESC'
+        return 'rank'
+
+    def _apply_colocation_hints(self):
+        """Puts the tables of each --colocate line into one co-location group"""
+        for (i, tables) in enumerate(self.options.colocation_hints):
+            sql = """UPDATE %s.%s SET colocation_group = 'hint:%d'
+                     WHERE dbname || '.' || fq_name IN (%s)""" % (
+                gpexpand_schema, status_detail_table, i, ', '.join("'%s'" % t for t in tables))
+            self.logger.debug(sql)
+            dbconn.execSQL(self.conn, sql)
+        self.conn.commit()
+
+    def _group_back_to_back(self, tables):
+        """Reorders tables so that the members of a co-location group, or the leaves
+        of a partitioned table, follow the first of them.  Joins between partners
+        become motion free together and a partitioned table is only briefly mixed."""
+        members = {}
+        for tbl in tables:
+            if tbl.schedule_group():
+                members.setdefault(tbl.schedule_group(), []).append(tbl)
+
+        ordered = []
+        for tbl in tables:
+            if not tbl.schedule_group():
+                ordered.append(tbl)
+            elif tbl.schedule_group() in members:
+                ordered.extend(members.pop(tbl.schedule_group()))
+        return ordered
+
+    def _hot_scan_threshold(self):
+        """Returns the scan count above which a table counts as frequently scanned"""
+        sql = "SELECT count(*) FROM %s.%s" % (gpexpand_schema, status_detail_table)
+        offset = int(dbconn.execSQLForSingleton(self.conn, sql) * HOT_TABLE_FRACTION)
+        sql = """SELECT coalesce(scan_count, 0) FROM %s.%s
+                 ORDER BY coalesce(scan_count, 0) DESC LIMIT 1 OFFSET %d""" % (
+            gpexpand_schema, status_detail_table, offset)
+        cursor = dbconn.execSQL(self.conn, sql)
+        row = cursor.fetchone()
+        self.conn.commit()
+        return row[0] if row else 0
+
+    def _claim_tables(self, count, hot_threshold=None):
+        """Atomically claims up to count unclaimed tables in queue order, leaving
+        out tables scanned more than hot_threshold times if it is given"""
+        hot_filter = ''
+        if hot_threshold is not None:
+            hot_filter = 'AND coalesce(scan_count, 0) <= %d' % hot_threshold
+        dbconn.execSQL(self.conn, 'LOCK TABLE %s.%s IN EXCLUSIVE MODE' % (gpexpand_schema, status_detail_table))
+        sql = """SELECT %s FROM %s.%s
+                 WHERE status = '%s' AND claimed_by IS NULL %s
+                 ORDER BY %s LIMIT %d""" % (status_detail_columns, gpexpand_schema,
+                                            status_detail_table, undone_status, hot_filter,
+                                            self._queue_order(), count)
+        rows = dbconn.execSQL(self.conn, sql).fetchall()
+        # claim the whole co-location group or partitioned table of every claimed table
+        tables = [ExpandTable(options=self.options, row=row) for row in rows]
+        groups = set("colocation_group = '%s'" % t.colocation_group for t in tables if t.colocation_group)
+        groups.update("(dbname = '%s' AND partition_root = '%s')" % (t.dbname, t.partition_root)
+                      for t in tables if t.partition_root and not t.colocation_group)
+        if groups:
+            claimed = set((row[0], row[3]) for row in rows)
+            sql = """SELECT %s FROM %s.%s
+                     WHERE status = '%s' AND claimed_by IS NULL AND (%s)""" % (
+                status_detail_columns, gpexpand_schema, status_detail_table, undone_status,
+                ' OR '.join(groups))
+            rows.extend(row for row in dbconn.execSQL(self.conn, sql) if (row[0], row[3]) not in claimed)
+        if rows:
+            keys = ' OR '.join("(dbname = '%s' AND table_oid = %s)" % (row[0], row[3]) for row in rows)
+            sql = """UPDATE %s.%s SET claimed_by = '%s'
+                     WHERE status = '%s' AND claimed_by IS NULL AND (%s)""" % (
+                gpexpand_schema, status_detail_table, self.driver_id, undone_status, keys)
+            dbconn.execSQL(self.conn, sql)
+        self.conn.commit()
+        return rows
+
+    def _deregister_driver(self):
+        """Releases unstarted claims and removes this driver.  Returns True if this
+        was the last live driver and no table is left to expand."""
+        dbconn.execSQL(self.conn, 'LOCK TABLE %s.%s IN EXCLUSIVE MODE' % (gpexpand_schema, drivers_table))
+        sql = """UPDATE %s.%s SET claimed_by = NULL
+                 WHERE claimed_by = '%s' AND status = '%s'""" % (
+            gpexpand_schema, status_detail_table, self.driver_id, undone_status)
+        dbconn.execSQL(self.conn, sql)
+        sql = "DELETE FROM %s.%s WHERE driver_id = '%s'" % (gpexpand_schema, drivers_table, self.driver_id)
+        dbconn.execSQL(self.conn, sql)
+        sql = """SELECT count(*) FROM %s.%s
+                 WHERE heartbeat > now() - interval '%d seconds'""" % (
+            gpexpand_schema, drivers_table, DRIVER_HEARTBEAT_TIMEOUT)
+        last_driver = dbconn.execSQLForSingleton(self.conn, sql) == 0
+        sql = "SELECT count(*) FROM %s.%s WHERE status IN ('%s', '%s')" % (
+            gpexpand_schema, status_detail_table, undone_status, start_status)
+        nothing_left = dbconn.execSQLForSingleton(self.conn, sql) == 0
+        self.conn.commit()
+        return last_driver and nothing_left
+
+    def perform_cooperative_expansion(self):
+        """Expands tables claimed from gpexpand.status_detail alongside other
+        --cooperative drivers.  Each driver heart-beats in gpexpand.drivers and
+        reclaims the tables of drivers that died."""
+        self.driver_id = '%s:%d' % (getLocalHostname(), os.getpid())
+        self.queue = WorkerPool(numWorkers=self.numworkers)
+        self.catalog_maintenance = CatalogMaintenance(self.logger, self.dburl,
+                                                      self.options.catalog_vacuum_interval)
+        self.skew_verifier = self._start_skew_verifier()
+        self.metrics = self._start_metrics()
+        self.conn = dbconn.connect(self.dburl, encoding='UTF8')
+        self._ensure_table(drivers_table, drivers_table_sql)
+        self._ensure_history()
+        self.segment_movement = self._start_segment_movement(self.driver_id)
+        self.table_progress = self._start_table_progress(self.driver_id)
+
+        first_driver = self._register_driver()
+        self.heartbeat = DriverHeartbeat(self.logger, self.dburl, self.driver_id)
+        if first_driver:
+            self._reset_unclaimed_in_progress()
+            self._apply_colocation_hints()
+            self._record_estimates()
+            self._rebuild_progress_counters(reset_window=True)
+            sql = "INSERT INTO %s.%s VALUES ( 'EXPANSION STARTED', '%s' ) " % (
+                gpexpand_schema, status_table, datetime.datetime.now())
+            dbconn.execSQL(self.conn, sql)
+            self.conn.commit()
+        else:
+            self._load_estimates()
+        self.logger.info('Registered as cooperative gpexpand driver %s' % self.driver_id)
+
+        stopTime = self.options.end
+        stoppedEarly = False
+        lease_lost = False
+        queue_exhausted = False
+        hot_threshold = self._hot_scan_threshold() if self.options.quiet_window else None
+        try:
+            while True:
+                if self.heartbeat.lost.is_set():
+                    # the tables of this driver are queued for the others now
+                    lease_lost = True
+                    break
+                self._reclaim_dead_drivers()
+
+                pending = self.queue.num_assigned - self.queue.completed_queue.qsize()
+                if not queue_exhausted and pending < self.numworkers:
+                    quiet = hot_threshold is None or in_quiet_hours(self.options.quiet_window)
+                    rows = self._claim_tables(2 * self.numworkers - pending,
+                                              None if quiet else hot_threshold)
+                    tables = [ExpandTable(options=self.options, row=row) for row in rows]
+                    for tbl in tables:
+                        tbl.predicted_seconds = self.estimates.get((tbl.dbname, tbl.table_oid), 0.0)
+                    for tbl in self._group_back_to_back(tables):
+                        self.logger.debug(tbl.fq_name)
+                        cmd = ExpandCommand(name="name", status_url=self.dburl, table=tbl, options=self.options,
+                                            catalog_maintenance=self.catalog_maintenance,
+                                            skew_verifier=self.skew_verifier, metrics=self.metrics,
+                                            segment_movement=self.segment_movement,
+                                            table_progress=self.table_progress)
+                        self.queue.addCommand(cmd)
+                    # outside the quiet hours the frequently scanned tables are still to come
+                    queue_exhausted = len(rows) == 0 and quiet
+
+                if queue_exhausted and self.queue.isDone():
+                    break
+                if stopTime and datetime.datetime.now() >= stopTime:
+                    stoppedEarly = True
+                    break
+                self.catalog_maintenance.vacuum_churned()
+                self._report_progress()
+                time.sleep(5)
+        finally:
+            self.queue.haltWork()
+            self.queue.joinWorkers()
+            if self.skew_verifier:
+                self.skew_verifier.finish()
+            self._report_progress()
+            if self.table_progress:
+                self.table_progress.stop()
+            if self.metrics:
+                self.metrics.stop()
+            self.heartbeat.stop()
+            self.heartbeat = None
+            timeline.close()
+
+        table_expand_error = False
+        for expandCommand in self.queue.getCompletedItems():
+            if expandCommand.table_expand_error:
+                table_expand_error = True
+                break
+
+        expansion_done = self._deregister_driver()
+        self.driver_id = None
+        if lease_lost:
+            logger.warn('Another driver took this one for dead and requeued its tables.  Stopping this driver.')
+        elif stoppedEarly:
+            logger.info('End time reached.  Stopping this driver.')
+        elif table_expand_error:
+            logger.warn('One or more tables failed to expand successfully.')
+            logger.warn('Please check the log file, correct the problem and')
+            logger.warn('run gpexpand again to finish the expansion process')
+
+        if expansion_done and not table_expand_error:
+            sql = "INSERT INTO %s.%s VALUES ( 'EXPANSION COMPLETE', '%s' ) " % (
+                gpexpand_schema, status_table, datetime.datetime.now())
+            dbconn.execSQL(self.conn, sql)
+            self.conn.commit()
+            logger.info("EXPANSION COMPLETED SUCCESSFULLY")
+        elif not stoppedEarly and not lease_lost and not table_expand_error:
+            logger.info('No tables left to claim.  Remaining tables are being expanded by other drivers.')
+
     def shutdown(self):
         """used if the script is closed abrubtly"""
         logger.info('Shutting down gpexpand...')
@@ -2316,7 +3212,23 @@ UPDATE gp_distribution_policy
             self.queue.haltWork()
             self.queue.joinWorkers()
 
+        if self.skew_verifier:
+            self.skew_verifier.halt()
+
+        if self.metrics:
+            self.metrics.stop()
+        if self.heartbeat:
+            self.heartbeat.stop()
+        timeline.close()
+
         try:
+            if self.driver_id:
+                # other cooperative drivers carry on with the expansion
+                self._deregister_driver()
+                self.driver_id = None
+                self.conn.close()
+                return
+
             expansionStopped = datetime.datetime.now()
             sql = "INSERT INTO %s.%s VALUES ( 'EXPANSION STOPPED', '%s' ) " % (
                 gpexpand_schema, status_table, expansionStopped)
@@ -2340,6 +3252,12 @@ UPDATE gp_distribution_policy
             self.queue.haltWork()
             self.queue.joinWorkers()
 
+        if self.skew_verifier:
+            self.skew_verifier.halt()
+
+        if self.metrics:
+            self.metrics.stop()
+
     def cleanup_schema(self, gpexpand_db_status):
         """Removes the gpexpand schema"""
         # drop schema
@@ -2483,26 +3401,65 @@ UPDATE gp_distribution_policy
         UpdateFlatFiles(self.gparray, primaries=False, expansion=True).run()
 
 
-    def validate_heap_checksums(self):
-        num_workers = min(len(self.gparray.get_hostlist()), MAX_PARALLEL_EXPANDS)
-        heap_checksum_util = HeapChecksum(gparray=self.gparray, num_workers=num_workers, logger=self.logger)
-        successes, failures = heap_checksum_util.get_segments_checksum_settings()
-        if len(successes) == 0:
-            logger.fatal("No segments responded to ssh query for heap checksum. Not expanding the cluster.")
-            return 1
+    def probe_hosts(self):
+        """Runs one HostProbe on every host of the master, the segments and the
+        new segments, once per run"""
+        if self.host_probes is not None:
+            return self.host_probes
 
-        consistent, inconsistent, master_heap_checksum = heap_checksum_util.check_segment_consistency(successes)
+        old_segments = {}
+        new_segments = {}
+        for seg in [self.gparray.master] + self.old_segments:
+            old_segments.setdefault(seg.getSegmentHostName(), []).append(seg)
+        for seg in self.gparray.getExpansionSegDbList():
+            new_segments.setdefault(seg.getSegmentHostName(), []).append(seg)
+        hosts = set(old_segments.keys() + new_segments.keys())
 
-        inconsistent_segment_msgs = []
-        for segment in inconsistent:
-            inconsistent_segment_msgs.append("dbid: %s "
-                                             "checksum set to %s differs from master checksum set to %s" %
-                                             (segment.getSegmentDbId(), segment.heap_checksum,
-                                              master_heap_checksum))
+        self.logger.info('Probing %d hosts' % len(hosts))
+        pool = WorkerPool(numWorkers=min(len(hosts), MAX_PARALLEL_EXPANDS))
+        try:
+            for host in hosts:
+                pool.addCommand(HostProbe('gpexpand probe host %s' % host, host,
+                                          old_segments.get(host, []), new_segments.get(host, [])))
+            journal.join(pool, 'gpexpand probe hosts')
+            finished = pool.getCompletedItems()
+        finally:
+            pool.haltWork()
+            pool.joinWorkers()
 
-        if not heap_checksum_util.are_segments_consistent(consistent, inconsistent):
-            self.logger.fatal("Cluster heap checksum setting differences reported")
-            self.logger.fatal("Heap checksum settings on %d of %d segment instances do not match master <<<<<<<<"
+        self.host_probes = {}
+        for cmd in finished:
+            if not cmd.was_successful():
+                self.logger.warn('Could not probe host %s: %s' % (cmd.host, cmd.get_results().stderr.strip()))
+            self.host_probes[cmd.host] = cmd
+        return self.host_probes
+
+    def validate_heap_checksums(self):
+        checksums = {}
+        for probe in self.probe_hosts().values():
+            checksums.update(probe.checksums)
+
+        master_dbid = self.gparray.master.getSegmentDbId()
+        if master_dbid not in checksums:
+            raise Exception("Could not read the heap checksum setting of the master")
+        master_heap_checksum = checksums[master_dbid]
+
+        responded = [seg for seg in self.old_segments if seg.getSegmentDbId() in checksums]
+        if len(responded) == 0:
+            logger.fatal("No segments responded to ssh query for heap checksum. Not expanding the cluster.")
+            return 1
+
+        inconsistent_segment_msgs = []
+        for segment in responded:
+            if checksums[segment.getSegmentDbId()] != master_heap_checksum:
+                inconsistent_segment_msgs.append("dbid: %s "
+                                                 "checksum set to %s differs from master checksum set to %s" %
+                                                 (segment.getSegmentDbId(), checksums[segment.getSegmentDbId()],
+                                                  master_heap_checksum))
+
+        if inconsistent_segment_msgs:
+            self.logger.fatal("Cluster heap checksum setting differences reported")
+            self.logger.fatal("Heap checksum settings on %d of %d segment instances do not match master <<<<<<<<"
                               % (len(inconsistent_segment_msgs), len(self.gparray.segments)))
             self.logger.fatal("Review %s for details" % get_logfile())
             log_to_file_only("Failed checksum consistency validation:", logging.WARN)
@@ -2511,32 +3468,72 @@ UPDATE gp_distribution_policy
 
             for msg in inconsistent_segment_msgs:
                 log_to_file_only(msg, logging.WARN)
-                raise Exception("Segments have heap_checksum set inconsistently to master")
+            raise Exception("Segments have heap_checksum set inconsistently to master")
         else:
             self.logger.info("Heap checksum setting consistent across cluster")
 
+    def validate_new_segment_hosts(self):
+        """Checks with the host probes that the ports and directories of the new
+        segments are free, and reports the free space left on each host"""
+        probes = self.probe_hosts()
+        valid = True
+        for seg in self.gparray.getExpansionSegDbList():
+            host = seg.getSegmentHostName()
+            probe = probes[host]
+            if not probe.was_successful():
+                self.logger.error('Could not probe host %s of new segment dbid %d' % (host, seg.getSegmentDbId()))
+                valid = False
+                continue
+            if not probe.listening:
+                self.logger.error('Could not check the ports of new segment dbid %d on host %s: '
+                                  'neither netstat nor ss listed any listening sockets' % (seg.getSegmentDbId(), host))
+                valid = False
+            for port in (seg.getSegmentPort(), seg.getSegmentReplicationPort()):
+                if port and port in probe.ports_in_use:
+                    self.logger.error('Port %d of new segment dbid %d is already in use on host %s' % (
+                        port, seg.getSegmentDbId(), host))
+                    valid = False
+            for path in set(seg.getSegmentFilespaces().values() + [seg.getSegmentDataDirectory()]):
+                if probe.dir_entries.get(path, 0) > 0:
+                    self.logger.error('Directory %s of new segment dbid %d on host %s is not empty' % (
+                        path, seg.getSegmentDbId(), host))
+                    valid = False
+
+        for host in sorted(probes.keys()):
+            free_kb = probes[host].free_kb
+            if free_kb:
+                path = min(free_kb, key=free_kb.get)
+                self.logger.info('Host %s: %d MB free under %s, its least free segment directory' % (
+                    host, free_kb[path] / 1024, path))
+        return valid
+
 
 # -----------------------------------------------
 class ExpandTable():
     def __init__(self, options, row=None):
         self.options = options
+        self.predicted_seconds = 0.0
+        self.timings = {}
+        self.spans = []
+        self.segment_bytes = None
         if row is not None:
             (self.dbname, self.fq_name, self.schema_oid, self.table_oid,
              self.distrib_policy, self.distrib_policy_names, self.distrib_policy_coloids,
              self.storage_options, self.rank, self.status,
              self.expansion_started, self.expansion_finished,
-             self.source_bytes) = row
+             self.source_bytes, self.expansion_phase, self.claimed_by,
+             self.scan_count, self.colocation_group, self.partition_root) = row
 
     def add_table(self, conn):
         insertSQL = """INSERT INTO %s.%s
                             VALUES ('%s','%s',%s,%s,
-                                    '%s','%s','%s','%s',%d,'%s','%s','%s',%d)
+                                    '%s','%s','%s','%s',%d,'%s','%s','%s',%d,NULL,NULL,%d,NULL,NULL)
                     """ % (gpexpand_schema, status_detail_table,
                            self.dbname, self.fq_name, self.schema_oid, self.table_oid,
                            self.distrib_policy, self.distrib_policy_names, self.distrib_policy_coloids,
                            self.storage_options, self.rank, self.status,
                            self.expansion_started, self.expansion_finished,
-                           self.source_bytes)
+                           self.source_bytes, self.scan_count)
         logger.info('Added table %s.%s' % (self.dbname.decode('utf-8'), self.fq_name.decode('utf-8')))
         logger.debug(insertSQL.decode('utf-8'))
         dbconn.execSQL(conn, insertSQL)
@@ -2544,12 +3541,11 @@ class ExpandTable():
     def mark_started(self, status_conn, table_conn, start_time, cancel_flag):
         if cancel_flag:
             return
-        (schema_name, table_name) = self.fq_name.split('.')
-        sql = "SELECT pg_relation_size(quote_ident('%s') || '.' || quote_ident('%s'))" % (schema_name, table_name)
-        cursor = dbconn.execSQL(table_conn, sql)
-        row = cursor.fetchone()
-        src_bytes = int(row[0])
+        phase_start = datetime.datetime.now()
+        self.segment_bytes = self.segment_sizes(table_conn)
+        src_bytes = sum(self.segment_bytes.values())
         logger.debug(" Table: %s has %d bytes" % (self.fq_name.decode('utf-8'), src_bytes))
+        phase_start = self.time_phase('size_query', phase_start)
 
         sql = """UPDATE %s.%s
                   SET status = '%s', expansion_started='%s',
@@ -2562,19 +3558,263 @@ class ExpandTable():
 
         logger.debug("Mark Started: " + sql.decode('utf-8'))
         dbconn.execSQL(status_conn, sql)
+        self._count_transition(status_conn, start_status, src_bytes)
         status_conn.commit()
+        self.time_phase('mark_started', phase_start)
+
+    def segment_sizes(self, table_conn):
+        """Returns the size of this table on every segment by gp_segment_id"""
+        (schema_name, table_name) = self.fq_name.split('.')
+        sql = """SELECT gp_segment_id, pg_relation_size(quote_ident('%s') || '.' || quote_ident('%s'))
+                 FROM gp_dist_random('gp_id')""" % (schema_name, table_name)
+        return dict((row[0], int(row[1])) for row in dbconn.execSQL(table_conn, sql))
+
+    def time_phase(self, phase, since):
+        """Adds the time since since to phase of this attempt for the --journal
+        and --trace.  Returns the current time, the start of the next phase."""
+        now = datetime.datetime.now()
+        self.timings[phase] = self.timings.get(phase, 0) + (now - since).total_seconds()
+        self.spans.append((phase, since, now))
+        return now
 
     def reset_started(self, status_conn):
         sql = """UPDATE %s.%s
-                 SET status = '%s', expansion_started=NULL, expansion_finished=NULL
+                 SET status = '%s', expansion_started=NULL, expansion_finished=NULL,
+                     expansion_phase=NULL
                  WHERE dbname = '%s' AND schema_oid = %s
                  AND table_oid = %s """ % (gpexpand_schema, status_detail_table, undone_status,
                                            self.dbname, self.schema_oid, self.table_oid)
 
         logger.debug('Reseting detailed_status: %s' % sql.decode('utf-8'))
         dbconn.execSQL(status_conn, sql)
+        self._count_transition(status_conn, undone_status, self.source_bytes)
         status_conn.commit()
 
+    def _count_transition(self, status_conn, new_status, new_bytes, start_time=None, finish_time=None):
+        """Moves this table between the rows of gpexpand.progress_counters.
+        The caller commits, together with the status_detail update."""
+        if new_status == self.status and new_bytes == self.source_bytes:
+            return
+        sql = """UPDATE %s.%s
+                 SET tables = tables - 1, bytes = bytes - %s, predicted_seconds = predicted_seconds - %f
+                 WHERE status = '%s'""" % (gpexpand_schema, progress_counters_table,
+                                           self.source_bytes or 0, self.predicted_seconds, self.status)
+        dbconn.execSQL(status_conn, sql)
+
+        window = ''
+        if new_status == done_status:
+            window = """, window_bytes = window_bytes + %s,
+                        window_started = least(coalesce(window_started, '%s'), '%s'),
+                        window_finished = greatest(coalesce(window_finished, '%s'), '%s')""" % (
+                new_bytes or 0, start_time, start_time, finish_time, finish_time)
+        sql = """UPDATE %s.%s
+                 SET tables = tables + 1, bytes = bytes + %s, predicted_seconds = predicted_seconds + %f%s
+                 WHERE status = '%s'""" % (gpexpand_schema, progress_counters_table,
+                                           new_bytes or 0, self.predicted_seconds, window, new_status)
+        dbconn.execSQL(status_conn, sql)
+        (self.status, self.source_bytes) = (new_status, new_bytes)
+
+    def schedule_group(self):
+        """Returns the key of the tables to expand back-to-back with this one"""
+        if self.colocation_group:
+            return self.colocation_group
+        if self.partition_root:
+            return 'root:%s.%s' % (self.dbname, self.partition_root)
+        return None
+
+    def set_phase(self, status_conn, phase):
+        sql = """UPDATE %s.%s
+                 SET expansion_phase = '%s'
+                 WHERE dbname = '%s' AND schema_oid = %s
+                 AND table_oid = %s """ % (gpexpand_schema, status_detail_table, phase,
+                                           self.dbname, self.schema_oid, self.table_oid)
+
+        logger.debug('Setting expansion phase: %s' % sql.decode('utf-8'))
+        dbconn.execSQL(status_conn, sql)
+        status_conn.commit()
+
+    def _distributed_by_clause(self):
+        policy_names = self.distrib_policy_names.strip()
+        if policy_names == "" or policy_names == "None" or policy_names is None:
+            return 'DISTRIBUTED RANDOMLY'
+        dist_cols = ['"%s"' % x.strip() for x in policy_names.split(',')]
+        return 'DISTRIBUTED BY (%s)' % ','.join(dist_cols)
+
+    def check_online_eligible(self, table_conn):
+        """Raises OnlineRedistributionError if the table has objects depending on
+        it, or privileges granted on it, that would not follow it through a
+        rename swap.  Comments are carried over by comment_statements()."""
+        sql = """
+SELECT
+    c.relkind = 'r'
+    AND c.relacl IS NULL
+    AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_partition WHERE parrelid = c.oid)
+    AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_partition_rule WHERE parchildrelid = c.oid)
+    AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_inherits
+                    WHERE inhrelid = c.oid OR inhparent = c.oid)
+    AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_attribute_encoding WHERE attrelid = c.oid)
+    AND NOT EXISTS (
+        SELECT 1 FROM pg_catalog.pg_depend d
+        WHERE d.refclassid = 'pg_catalog.pg_class'::regclass
+          AND d.refobjid = c.oid
+          AND (d.classid IN ('pg_catalog.pg_rewrite'::regclass, 'pg_catalog.pg_trigger'::regclass)
+               OR (d.classid = 'pg_catalog.pg_constraint'::regclass AND d.deptype = 'n')
+               OR (d.classid = 'pg_catalog.pg_class'::regclass
+                   AND d.objid IN (SELECT oid FROM pg_catalog.pg_class WHERE relkind IN ('S', 'i')))))
+FROM pg_catalog.pg_class c
+WHERE c.oid = %s""" % self.table_oid
+        if not dbconn.execSQLForSingleton(table_conn, sql):
+            raise OnlineRedistributionError('table has grants, indexes, views, triggers, owned sequences, '
+                                            'foreign keys, column encodings or partitions')
+
+    def comment_statements(self, table_conn, shadow):
+        """COMMENT statements that put the comments of the table and its
+        columns on the shadow table, which gets a new oid"""
+        sql = """
+SELECT 'COMMENT ON ' || CASE WHEN d.objsubid = 0 THEN 'TABLE %s'
+                             ELSE 'COLUMN %s.' || pg_catalog.quote_ident(a.attname) END
+       || ' IS ' || pg_catalog.quote_literal(d.description)
+FROM pg_catalog.pg_description d
+LEFT JOIN pg_catalog.pg_attribute a ON (a.attrelid = d.objoid AND a.attnum = d.objsubid)
+WHERE d.classoid = 'pg_catalog.pg_class'::regclass AND d.objoid = %s""" % (shadow, shadow, self.table_oid)
+        return [row[0] for row in dbconn.execSQL(table_conn, sql).fetchall()]
+
+    def check_watermark(self, table_conn, orig, col):
+        """Raises OnlineRedistributionError if the watermark column does not
+        exist or cannot be ordered, which the catch up rounds rely on"""
+        try:
+            dbconn.execSQL(table_conn, 'SELECT max(%s) FROM %s WHERE %s < %s AND false' % (col, orig, col, col))
+        except Exception, e:
+            table_conn.rollback()
+            raise OnlineRedistributionError('watermark column %s cannot be used: %s' % (col, str(e).strip()))
+        table_conn.commit()
+
+    def write_count(self, table_conn):
+        """Rows updated or deleted in the table on all the segments, from their
+        statistics counters.  Backends report these at most every 500ms, so
+        the count can lag the last few writes."""
+        sql = """SELECT sum(pg_stat_get_tuples_updated(%s) + pg_stat_get_tuples_deleted(%s))
+                 FROM gp_dist_random('gp_id')""" % (self.table_oid, self.table_oid)
+        return int(dbconn.execSQLForSingleton(table_conn, sql) or 0)
+
+    def expand_online(self, status_conn, table_conn, watermark, cancel_flag):
+        """Redistributes the table into a shadow copy while the original stays
+        readable, catches up rows appended during the copy using the watermark
+        column and finally swaps the two tables under a short exclusive lock.
+
+        Raises OnlineRedistributionError if the copy cannot converge, or if the
+        table saw UPDATEs or DELETEs meanwhile, which the watermark cannot
+        follow; the shadow table is dropped and the caller falls back to
+        expand()."""
+        (schema_name, table_name) = self.fq_name.split('.')
+        orig = '"%s"."%s"' % (schema_name, table_name)
+        shadow_name = 'gpexpand_shadow_%s' % self.table_oid
+        old_name = 'gpexpand_old_%s' % self.table_oid
+        shadow = '"%s"."%s"' % (schema_name, shadow_name)
+        col = '"%s"' % watermark
+
+        self.check_online_eligible(table_conn)
+        self.check_watermark(table_conn, orig, col)
+
+        # the shadow inherits the storage options and owner of the original
+        sql = """SELECT array_to_string(c.reloptions, ','), r.rolname
+                 FROM pg_catalog.pg_class c JOIN pg_catalog.pg_roles r ON (c.relowner = r.oid)
+                 WHERE c.oid = %s""" % self.table_oid
+        (reloptions, owner) = dbconn.execSQL(table_conn, sql).fetchone()
+        with_clause = 'WITH (%s) ' % reloptions if reloptions else ''
+
+        if cancel_flag:
+            return False
+
+        logger.info('Copying %s.%s into shadow table %s' % (self.dbname.decode('utf-8'),
+                                                            self.fq_name.decode('utf-8'), shadow_name))
+        self.set_phase(status_conn, copying_phase)
+        try:
+            writes_before = self.write_count(table_conn)
+            dbconn.execSQL(table_conn, 'DROP TABLE IF EXISTS %s' % shadow)
+            dbconn.execSQL(table_conn, 'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS) %s%s' % (
+                shadow, orig, with_clause, self._distributed_by_clause()))
+            dbconn.execSQL(table_conn, 'ALTER TABLE %s OWNER TO "%s"' % (shadow, owner))
+            table_conn.commit()
+
+            high_water = dbconn.execSQLForSingleton(table_conn, 'SELECT max(%s) FROM %s' % (col, orig))
+            if high_water is not None:
+                dbconn.execSQL(table_conn, "INSERT INTO %s SELECT * FROM %s WHERE %s <= '%s'" % (
+                    shadow, orig, col, high_water))
+                table_conn.commit()
+
+            self.set_phase(status_conn, catchup_phase)
+            converged = False
+            for catchup_round in range(ONLINE_MAX_CATCHUP_ROUNDS):
+                new_high_water = dbconn.execSQLForSingleton(table_conn, 'SELECT max(%s) FROM %s' % (col, orig))
+                if new_high_water is None or new_high_water == high_water:
+                    converged = True
+                    break
+                if high_water is None:
+                    cursor = dbconn.execSQL(table_conn, "INSERT INTO %s SELECT * FROM %s WHERE %s <= '%s'" % (
+                        shadow, orig, col, new_high_water))
+                else:
+                    cursor = dbconn.execSQL(table_conn, "INSERT INTO %s SELECT * FROM %s WHERE %s > '%s' AND %s <= '%s'" % (
+                        shadow, orig, col, high_water, col, new_high_water))
+                table_conn.commit()
+                high_water = new_high_water
+                logger.debug('Catch up round %d of %s copied %d rows' % (catchup_round + 1,
+                                                                         self.fq_name.decode('utf-8'),
+                                                                         cursor.rowcount))
+                if cursor.rowcount <= ONLINE_CONVERGED_ROWS:
+                    converged = True
+                    break
+            if not converged:
+                raise OnlineRedistributionError('catch up did not converge after %d rounds' %
+                                                ONLINE_MAX_CATCHUP_ROUNDS)
+
+            # the full scans run before the lock: every row up to the high water
+            # mark must be in the copy, which also catches rows appended below it
+            if high_water is not None:
+                orig_rows = dbconn.execSQLForSingleton(table_conn, "SELECT count(*) FROM %s WHERE %s <= '%s'" % (
+                    orig, col, high_water))
+                shadow_rows = dbconn.execSQLForSingleton(table_conn, 'SELECT count(*) FROM %s' % shadow)
+                table_conn.commit()
+                if orig_rows != shadow_rows:
+                    raise OnlineRedistributionError('%d rows up to the watermark in the original but %d in the '
+                                                    'shadow copy' % (orig_rows, shadow_rows))
+            for statement in self.comment_statements(table_conn, shadow):
+                dbconn.execSQL(table_conn, statement)
+            table_conn.commit()
+
+            # under the lock only the rows above the high water mark are copied.
+            # Updated or deleted rows cannot be seen that way, so any change of
+            # the counters since the copy started sends the table to expand();
+            # the short settle lets the last writes before the lock reach them
+            self.set_phase(status_conn, swapping_phase)
+            dbconn.execSQL(table_conn, 'LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % orig)
+            if high_water is None:
+                dbconn.execSQL(table_conn, 'INSERT INTO %s SELECT * FROM %s' % (shadow, orig))
+            else:
+                dbconn.execSQL(table_conn, "INSERT INTO %s SELECT * FROM %s WHERE %s > '%s'" % (
+                    shadow, orig, col, high_water))
+            sleep(ONLINE_STATS_SETTLE_SECONDS)
+            if self.write_count(table_conn) != writes_before:
+                raise OnlineRedistributionError('rows were updated or deleted during the copy')
+            dbconn.execSQL(table_conn, 'ALTER TABLE %s RENAME TO "%s"' % (orig, old_name))
+            dbconn.execSQL(table_conn, 'ALTER TABLE %s RENAME TO "%s"' % (shadow, table_name))
+            table_conn.commit()
+        except Exception:
+            table_conn.rollback()
+            dbconn.execSQL(table_conn, 'DROP TABLE IF EXISTS %s' % shadow)
+            table_conn.commit()
+            raise
+
+        dbconn.execSQL(table_conn, 'DROP TABLE "%s"."%s"' % (schema_name, old_name))
+        table_conn.commit()
+
+        if self.options.analyze:
+            logger.info('Analyzing %s.%s' % (schema_name.decode('utf-8'), table_name.decode('utf-8')))
+            dbconn.execSQL(table_conn, 'ANALYZE %s' % orig)
+            table_conn.commit()
+
+        return True
+
     def expand(self, table_conn, cancel_flag):
         foo = self.distrib_policy_names.strip()
         new_storage_options = ''
@@ -2601,13 +3841,16 @@ class ExpandTable():
 
         # check is atomic in python
         if not cancel_flag:
+            phase_start = datetime.datetime.now()
             dbconn.execSQL(table_conn, sql)
             table_conn.commit()
+            phase_start = self.time_phase('alter', phase_start)
             if self.options.analyze:
                 sql = 'ANALYZE "%s"."%s"' % (schema_name, table_name)
                 logger.info('Analyzing %s.%s' % (schema_name.decode('utf-8'), table_name.decode('utf-8')))
                 dbconn.execSQL(table_conn, sql)
                 table_conn.commit()
+                self.time_phase('analyze', phase_start)
 
             return True
 
@@ -2623,6 +3866,28 @@ class ExpandTable():
                                             self.dbname, self.schema_oid, self.table_oid)
         logger.debug(sql.decode('utf-8'))
         dbconn.execSQL(status_conn, sql)
+        self._count_transition(status_conn, done_status, self.source_bytes, start_time, finish_time)
+        status_conn.commit()
+
+    def record_history(self, status_conn, table_conn, start_time, finish_time, concurrency):
+        """Appends the outcome to the history later expansions learn their
+        throughput from.  Tables whose size was not measured (--simple-progress)
+        are left out, they would teach the model that rewrites cost nothing."""
+        if self.options.simple_progress or not self.source_bytes:
+            return
+        (schema_name, table_name) = self.fq_name.split('.')
+        sql = """SELECT c.relstorage, array_to_string(c.reloptions, ','),
+                        (SELECT count(*) FROM pg_catalog.pg_index i WHERE i.indrelid = c.oid)
+                 FROM pg_catalog.pg_class c WHERE c.oid = '"%s"."%s"'::regclass""" % (schema_name, table_name)
+        (relstorage, reloptions, indexes) = dbconn.execSQL(table_conn, sql).fetchone()
+        table_conn.commit()
+
+        sql = """INSERT INTO %s.%s VALUES ('%s', '%s', '%s', '%s', %d, %s, %f, %d, '%s', '%s')""" % (
+            history_schema, table_history_table, self.dbname, self.fq_name, relstorage,
+            ThroughputModel.compresstype(reloptions), indexes, self.source_bytes or 0,
+            (finish_time - start_time).total_seconds(), concurrency, start_time, finish_time)
+        logger.debug(sql.decode('utf-8'))
+        dbconn.execSQL(status_conn, sql)
         status_conn.commit()
 
     def mark_does_not_exist(self, status_conn, finish_time):
@@ -2634,9 +3899,1141 @@ class ExpandTable():
                                             self.dbname, self.schema_oid, self.table_oid)
         logger.debug(sql.decode('utf-8'))
         dbconn.execSQL(status_conn, sql)
+        self._count_transition(status_conn, does_not_exist_status, self.source_bytes)
         status_conn.commit()
 
 
+# -----------------------------------------------
+class PreflightCommand(SQLCommand):
+    """Runs a list of (check, sql) catalog checks against one database in a
+    single session, keeping the rows and the seconds taken by each check."""
+
+    def __init__(self, name, dburl, dbname, checks, utility):
+        self.url = copy.deepcopy(dburl)
+        self.url.pgdb = dbname
+        self.dbname = dbname
+        self.checks = checks
+        self.utility = utility
+        self.rows = {}
+        self.timings = []
+        self.error = None
+        SQLCommand.__init__(self, name)
+
+    def run(self, validateAfter=False):
+        conn = None
+        try:
+            start = datetime.datetime.now()
+            conn = dbconn.connect(self.url, utility=self.utility, encoding='UTF8')
+            self.timings.append(('connect', (datetime.datetime.now() - start).total_seconds()))
+            for (check, sql) in self.checks:
+                start = datetime.datetime.now()
+                self.rows[check] = dbconn.execSQL(conn, sql).fetchall()
+                self.timings.append((check, (datetime.datetime.now() - start).total_seconds()))
+        except Exception, e:
+            self.error = e
+        finally:
+            if conn:
+                conn.close()
+
+
+def run_preflight_checks(dburl, databases, checks, utility, title):
+    """Runs the checks against every database, PREFLIGHT_WORKERS databases at
+    a time, and logs one report of the time taken per check.  Raises the
+    first failure; returns the PreflightCommand of each database otherwise."""
+    start = datetime.datetime.now()
+    pool = WorkerPool(numWorkers=max(1, min(PREFLIGHT_WORKERS, len(databases))))
+    try:
+        for dbname in databases:
+            pool.addCommand(PreflightCommand('gpexpand preflight %s' % dbname, dburl, dbname, checks, utility))
+        pool.join()
+        commands = pool.getCompletedItems()
+    finally:
+        pool.haltWork()
+        pool.joinWorkers()
+
+    totals = {}
+    slowest = {}
+    order = ['connect'] + [check for (check, sql) in checks]
+    for cmd in commands:
+        for (check, seconds) in cmd.timings:
+            totals[check] = totals.get(check, 0) + seconds
+            if seconds >= slowest.get(check, (None, -1))[1]:
+                slowest[check] = (cmd.dbname, seconds)
+
+    logger.info('%s: %d databases in %.1f seconds' % (
+        title, len(databases), (datetime.datetime.now() - start).total_seconds()))
+    for check in order:
+        if check in totals:
+            logger.info('  %-20s %8.1f s total, slowest %s (%.1f s)' % (
+                check, totals[check], slowest[check][0].decode('utf-8'), slowest[check][1]))
+
+    for cmd in commands:
+        if cmd.error is not None:
+            raise cmd.error
+    return commands
+
+
+# -----------------------------------------------
+class PopulateDatabaseCommand(SQLCommand):
+    """Prepares one database: scans its catalog into status_detail rows, put on
+    the rows queue for the main thread to load, then nulls its distribution
+    policies unless another database has already failed."""
+
+    def __init__(self, name, expansion, dbname, rows, aborted):
+        self.expansion = expansion
+        self.dbname = dbname
+        self.rows = rows
+        self.aborted = aborted
+        SQLCommand.__init__(self, name)
+
+    def run(self, validateAfter=False):
+        error = None
+        try:
+            self.expansion.logger.info('Populating %s.%s with data from database %s' % (
+                gpexpand_schema, status_detail_table, self.dbname.decode('utf-8')))
+            table_conn = self.expansion.connect_database(self.dbname)
+            try:
+                self.expansion._load_relation_stats(table_conn)
+                self.expansion._populate_regular_tables(table_conn, self.dbname, self._sink)
+                self.expansion._populate_partitioned_tables(table_conn, self.dbname, self._sink)
+            finally:
+                table_conn.close()
+            inject_fault('gpexpand MPP-14620 fault injection')
+            if not self.aborted.is_set():
+                self.expansion._update_distribution_policy(self.dbname)
+        except Exception, e:
+            error = e
+        finally:
+            self._put(('done', self.dbname, error))
+
+    def _put(self, item):
+        """Queues item for the main thread, giving up if the load was aborted"""
+        while not self.aborted.is_set():
+            try:
+                self.rows.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _sink(self, text):
+        if not self._put(('rows', text)):
+            raise ExpansionError('population of %s.%s was aborted' % (gpexpand_schema, status_detail_table))
+
+
+# -----------------------------------------------
+class DriverHeartbeat:
+    """Refreshes the heartbeat of a --cooperative driver in gpexpand.drivers
+    every DRIVER_HEARTBEAT_INTERVAL seconds on its own thread and connection,
+    so a slow vacuum or progress sample in the main loop does not get the
+    tables of a live driver reclaimed by the others.  Sets lost once the
+    driver's row is gone, i.e. another driver took it for dead and handed its
+    tables back to the queue."""
+
+    def __init__(self, logger, dburl, driver_id):
+        self.logger = logger
+        self.dburl = dburl
+        self.driver_id = driver_id
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        sql = """UPDATE %s.%s SET heartbeat = now() WHERE driver_id = '%s'""" % (
+            gpexpand_schema, drivers_table, self.driver_id)
+        conn = None
+        while not self.stopped.is_set():
+            try:
+                if conn is None:
+                    conn = dbconn.connect(self.dburl, encoding='UTF8')
+                cursor = dbconn.execSQL(conn, sql)
+                conn.commit()
+                if cursor.rowcount == 0:
+                    self.logger.error('Driver %s was reclaimed by another gpexpand driver' % self.driver_id)
+                    self.lost.set()
+                    break
+            except Exception, e:
+                self.logger.warn('Could not record the heartbeat of driver %s: %s' % (self.driver_id, e))
+                if conn:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn = None
+            self.stopped.wait(DRIVER_HEARTBEAT_INTERVAL)
+        if conn:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+# -----------------------------------------------
+class CatalogMaintenance:
+    """Counts the table rewrites done per database and vacuums the catalog
+    tables they churn once a database has seen vacuum_interval of them."""
+
+    def __init__(self, logger, dburl, vacuum_interval):
+        self.logger = logger
+        self.dburl = dburl
+        self.vacuum_interval = vacuum_interval
+        self.rewrites = {}
+        self.lock = threading.Lock()
+
+    def record_rewrite(self, dbname):
+        """Called by the expand workers after each finished table"""
+        with self.lock:
+            self.rewrites[dbname] = self.rewrites.get(dbname, 0) + 1
+
+    def vacuum_churned(self):
+        """Vacuums the databases past the interval.  Runs in the main thread
+        between worker batches; a plain VACUUM does not block the workers."""
+        if not self.vacuum_interval:
+            return
+        with self.lock:
+            due = [db for (db, count) in self.rewrites.items() if count >= self.vacuum_interval]
+            for dbname in due:
+                self.rewrites[dbname] = 0
+
+        for dbname in due:
+            try:
+                self.vacuum_catalog(dbname)
+            except Exception, e:
+                self.logger.warn('Catalog vacuum of database %s failed: %s' % (dbname.decode('utf-8'), e))
+
+    def _catalog_bytes(self, db):
+        sql = """SELECT sum(pg_relation_size(c.oid))
+                 FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON (c.relnamespace = n.oid)
+                 WHERE n.nspname = 'pg_catalog' AND c.relname IN (%s)""" % (
+            ', '.join("'%s'" % t for t in CHURNED_CATALOG_TABLES))
+        return int(db.query(sql).getresult()[0][0] or 0)
+
+    def vacuum_catalog(self, dbname):
+        db = pg.connect(dbname=dbname, host=self.dburl.pghost, port=self.dburl.pgport,
+                        user=self.dburl.pguser)
+        try:
+            before = self._catalog_bytes(db)
+            start = datetime.datetime.now()
+            for table in CHURNED_CATALOG_TABLES:
+                db.query('VACUUM pg_catalog.%s' % table)
+            after = self._catalog_bytes(db)
+            self.logger.info('Vacuumed catalog of database %s in %s: %d MB before, %d MB after' % (
+                dbname.decode('utf-8'), datetime.datetime.now() - start,
+                before / 1024 / 1024, after / 1024 / 1024))
+        finally:
+            db.close()
+
+
+# -----------------------------------------------
+class SkewVerifier:
+    """Estimates the data skew of expanded tables on its own small worker pool,
+    fed by the expand workers as tables finish."""
+
+    def __init__(self, logger, status_url, num_workers):
+        self.logger = logger
+        self.status_url = status_url
+        self.pool = WorkerPool(numWorkers=num_workers)
+
+    def submit(self, table):
+        self.pool.addCommand(VerifySkewCommand(name='gpexpand verify skew', status_url=self.status_url,
+                                               table=table))
+
+    def finish(self):
+        """Waits for the submitted tables to be verified"""
+        self.pool.join()
+        self.halt()
+
+    def halt(self):
+        self.pool.haltWork()
+        self.pool.joinWorkers()
+
+
+class VerifySkewCommand(SQLCommand):
+    """Records the skew coefficient (100 * stddev / mean) of the table's bytes
+    per segment.  A freshly rewritten table has no dead space, so its per
+    segment size tracks its row share, and reading it is one catalog probe
+    per segment however large the table is."""
+
+    def __init__(self, name, status_url, table):
+        self.status_url = status_url
+        self.table = table
+        self.table_url = copy.deepcopy(status_url)
+        self.table_url.pgdb = table.dbname
+        SQLCommand.__init__(self, name)
+
+    def run(self, validateAfter=False):
+        (schema_name, table_name) = self.table.fq_name.split('.')
+        sql = """SELECT count(*), min(bytes), max(bytes), sum(bytes),
+                        coalesce(100 * stddev_pop(bytes) / nullif(avg(bytes), 0), 0)
+                 FROM (SELECT gp_segment_id, pg_relation_size(c.oid) AS bytes
+                       FROM gp_dist_random('pg_class') c
+                       WHERE c.oid = '"%s"."%s"'::regclass) s""" % (schema_name, table_name)
+        table_conn = None
+        status_conn = None
+        try:
+            table_conn = dbconn.connect(self.table_url, encoding='UTF8')
+            (segments, min_bytes, max_bytes, total_bytes, coefficient) = dbconn.execSQL(table_conn, sql).fetchone()
+            if (total_bytes or 0) < SKEW_MIN_BYTES:
+                # a few rows or blocks apart make small tables look badly skewed
+                logger.debug('Not recording the skew of %s.%s, only %d bytes' % (
+                    self.table.dbname.decode('utf-8'), self.table.fq_name.decode('utf-8'), total_bytes or 0))
+                return
+
+            status_conn = dbconn.connect(self.status_url, encoding='UTF8')
+            sql = """INSERT INTO %s.%s VALUES ('%s', '%s', %d, %s, %s, %s, now())""" % (
+                gpexpand_schema, table_skew_table, self.table.dbname, self.table.fq_name,
+                segments, min_bytes, max_bytes, coefficient)
+            dbconn.execSQL(status_conn, sql)
+            status_conn.commit()
+
+            if coefficient > SKEW_WARNING_COEFFICIENT:
+                logger.warn('%s.%s is skewed after expansion, skew coefficient %.1f' % (
+                    self.table.dbname.decode('utf-8'), self.table.fq_name.decode('utf-8'), coefficient))
+        except Exception, ex:
+            logger.warn('Could not verify skew of %s.%s: %s' % (self.table.dbname.decode('utf-8'),
+                                                                self.table.fq_name.decode('utf-8'),
+                                                                str(ex).strip()))
+        finally:
+            if table_conn: table_conn.close()
+            if status_conn: status_conn.close()
+
+    def set_results(self, results):
+        raise ExecutionError("TODO:  must implement", None)
+
+    def get_results(self):
+        raise ExecutionError("TODO:  must implement", None)
+
+    def was_successful(self):
+        raise ExecutionError("TODO:  must implement", None)
+
+    def validate(self, expected_rc=0):
+        raise ExecutionError("TODO:  must implement", None)
+
+
+# -----------------------------------------------
+class SegmentMovement:
+    """Bytes every segment gained and shed while tables were redistributed, from
+    the per-segment sizes of each table before and after its rewrite.  The
+    expand workers record into memory; the main loop flushes this driver's
+    totals into gpexpand.segment_movement for the segment_progress and
+    host_progress views."""
+
+    def __init__(self, conn, driver):
+        self.driver = driver
+        sql = "SELECT content, hostname FROM pg_catalog.gp_segment_configuration WHERE role = 'p' AND content >= 0"
+        self.hosts = dict(dbconn.execSQL(conn, sql).fetchall())
+        conn.commit()
+        self.bytes_in = {}
+        self.bytes_out = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def record(self, before, after):
+        with self.lock:
+            for content in set(before) | set(after):
+                delta = after.get(content, 0) - before.get(content, 0)
+                if delta > 0:
+                    self.bytes_in[content] = self.bytes_in.get(content, 0) + delta
+                    self.dirty = True
+                elif delta < 0:
+                    self.bytes_out[content] = self.bytes_out.get(content, 0) - delta
+                    self.dirty = True
+
+    def by_host(self):
+        """Returns {hostname: (bytes_in, bytes_out)}"""
+        hosts = {}
+        with self.lock:
+            for content in set(self.bytes_in) | set(self.bytes_out):
+                host = self.hosts.get(content, str(content))
+                (bytes_in, bytes_out) = hosts.get(host, (0, 0))
+                hosts[host] = (bytes_in + self.bytes_in.get(content, 0), bytes_out + self.bytes_out.get(content, 0))
+        return hosts
+
+    def flush(self, conn):
+        with self.lock:
+            if not self.dirty:
+                return
+            rows = ["('%s', %d, '%s', %d, %d, now())" % (self.driver, content, self.hosts.get(content, ''),
+                                                        self.bytes_in.get(content, 0), self.bytes_out.get(content, 0))
+                    for content in sorted(set(self.bytes_in) | set(self.bytes_out))]
+            self.dirty = False
+        if not rows:
+            return
+        dbconn.execSQL(conn, "DELETE FROM %s.%s WHERE driver = '%s'" % (
+            gpexpand_schema, segment_movement_table, self.driver))
+        dbconn.execSQL(conn, 'INSERT INTO %s.%s VALUES %s' % (
+            gpexpand_schema, segment_movement_table, ', '.join(rows)))
+        conn.commit()
+
+
+# -----------------------------------------------
+class TableProgressMonitor:
+    """Estimates how far each large in-flight ALTER TABLE ... REORGANIZE has got.
+
+    The new relation the ALTER writes is not yet committed, so it shows up as a
+    relation the worker's backend holds a lock on but that pg_class does not
+    have.  Its files on the segments are stat'ed by name and summed, then
+    compared to source_bytes: a heap grows <oid>, <oid>.1, ... one
+    HEAP_SEGMENT_FILE_BYTES file after the other, and the rewrite writes an
+    append-optimized table into segment file 0, i.e. <oid> for row and
+    <oid>.<AOCS_FILES_PER_COLUMN * column> for column orientation.  Tables
+    under TABLE_PROGRESS_MIN_BYTES are left out as they finish before they
+    are worth measuring, as are tables outside the default tablespace."""
+
+    def __init__(self, logger, dburl, driver):
+        self.logger = logger
+        self.dburl = dburl
+        self.driver = driver
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.progress = {}
+        self.connections = {}
+        self.full_files = {}
+        self.last_sample = None
+        self.dirty = False
+
+    def table_started(self, table, pid):
+        if (table.source_bytes or 0) < TABLE_PROGRESS_MIN_BYTES:
+            return
+        with self.lock:
+            self.in_flight[(table.dbname, table.fq_name)] = (table, pid, datetime.datetime.now())
+
+    def table_finished(self, table):
+        with self.lock:
+            if self.in_flight.pop((table.dbname, table.fq_name), None):
+                self.progress.pop((table.dbname, table.fq_name), None)
+                self.full_files.pop((table.dbname, table.fq_name), None)
+                self.dirty = True
+
+    def _connect(self, dbname):
+        if dbname not in self.connections:
+            url = copy.deepcopy(self.dburl)
+            url.pgdb = dbname
+            self.connections[dbname] = dbconn.connect(url, encoding='UTF8')
+        return self.connections[dbname]
+
+    def _stat_files(self, conn, database_oid, files):
+        """Returns [(segment, bytes)] summed over files, a list of (segment,
+        file name) where a segment of None stands for all the segments"""
+        values = ', '.join("(%s, '%s')" % ('NULL::int' if segment is None else segment, name)
+                           for (segment, name) in files)
+        # evaluated on the segments, below the gather motion
+        sql = """SELECT s.segment, sum((pg_catalog.pg_stat_file('base/%d/' || f.name)).size)
+                 FROM (SELECT gp_segment_id AS segment FROM gp_dist_random('gp_id')) s
+                     JOIN (VALUES %s) AS f(segment, name) ON (f.segment IS NULL OR f.segment = s.segment)
+                 GROUP BY s.segment""" % (database_oid, values)
+        return [(int(row[0]), int(row[1])) for row in dbconn.execSQL(conn, sql)]
+
+    def _bytes_written(self, conn, table, pid):
+        (schema_name, table_name) = table.fq_name.split('.')
+        # the new relation is created before its toast and aoseg relations,
+        # which the rewrite also holds locks on
+        sql = """SELECT min(l.relation), d.oid, c.relstorage, c.relnatts
+                 FROM pg_catalog.pg_locks l, pg_catalog.pg_database d, pg_catalog.pg_class c
+                 WHERE l.pid = %d AND l.locktype = 'relation' AND l.database = d.oid
+                 AND d.datname = current_database()
+                 AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_class n WHERE n.oid = l.relation)
+                 AND c.oid = '"%s"."%s"'::regclass AND c.reltablespace = 0
+                 GROUP BY d.oid, c.relstorage, c.relnatts""" % (pid, schema_name, table_name)
+        row = dbconn.execSQL(conn, sql).fetchone()
+        if not row:
+            conn.commit()
+            return 0
+        (relation, database_oid, relstorage, natts) = row
+
+        if relstorage in ('a', 'c'):
+            files = [(None, '%d' % relation)]
+            if relstorage == 'c':
+                files.extend((None, '%d.%d' % (relation, AOCS_FILES_PER_COLUMN * column))
+                             for column in range(1, natts))
+            written = sum(size for (segment, size) in self._stat_files(conn, database_oid, files))
+        else:
+            # segment -> files filled up by earlier samples, not stat'ed again
+            (tracked, full_files) = self.full_files.get((table.dbname, table.fq_name), (None, {}))
+            if tracked != relation:
+                # first sample of this attempt
+                full_files = {}
+                self.full_files[(table.dbname, table.fq_name)] = (relation, full_files)
+                full_files.update((segment, 0) for (segment, size) in
+                                  self._stat_files(conn, database_oid, [(None, '%d' % relation)]))
+            written = sum(full_files.values()) * HEAP_SEGMENT_FILE_BYTES
+            pending = dict(full_files)
+            while pending:
+                sizes = self._stat_files(conn, database_oid, [
+                    (segment, '%d.%d' % (relation, n) if n else '%d' % relation)
+                    for (segment, n) in pending.items()])
+                written += sum(size for (segment, size) in sizes)
+                pending = dict((segment, pending[segment] + 1) for (segment, size) in sizes
+                               if size >= HEAP_SEGMENT_FILE_BYTES)
+                full_files.update(pending)
+        conn.commit()
+        return written
+
+    def sample(self):
+        """Measures every tracked table; called from the main loop, samples
+        once every TABLE_PROGRESS_INTERVAL seconds"""
+        now = datetime.datetime.now()
+        if self.last_sample and (now - self.last_sample).total_seconds() < TABLE_PROGRESS_INTERVAL:
+            return
+        self.last_sample = now
+        with self.lock:
+            in_flight = self.in_flight.items()
+
+        for (key, (table, pid, started)) in in_flight:
+            try:
+                written = self._bytes_written(self._connect(table.dbname), table, pid)
+            except Exception, e:
+                # a failed sample must not leave the connection in an aborted transaction
+                conn = self.connections.pop(table.dbname, None)
+                if conn:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                self.logger.debug('Could not measure the progress of %s.%s: %s' % (
+                    table.dbname.decode('utf-8'), table.fq_name.decode('utf-8'), e))
+                continue
+            (previous, previous_time) = (0, started)
+            if key in self.progress:
+                (previous, previous_time) = (self.progress[key][0], self.progress[key][3])
+            rate = max(written - previous, 0) / max((now - previous_time).total_seconds(), 1)
+            percent = min(100.0 * written / max(float(table.source_bytes or 0), 1), 100.0)
+            with self.lock:
+                if key in self.in_flight:
+                    self.progress[key] = (written, percent, rate, now)
+                    self.dirty = True
+            self.logger.info('%s.%s is %.0f%% expanded, writing %.1f MB/s' % (
+                table.dbname.decode('utf-8'), table.fq_name.decode('utf-8'), percent, rate / 1024 / 1024))
+
+    def current(self):
+        """Returns [(dbname, fq_name, percent, bytes per second)] of the sampled tables"""
+        with self.lock:
+            return [(key[0], key[1], percent, rate)
+                    for (key, (written, percent, rate, sampled)) in sorted(self.progress.items())]
+
+    def flush(self, conn):
+        with self.lock:
+            if not self.dirty:
+                return
+            rows = ["('%s', '%s', '%s', %s, %d, %f, %f, %f, '%s')" % (
+                self.driver, key[0], key[1], self.in_flight[key][0].source_bytes or 0, written, percent, rate,
+                self.in_flight[key][0].predicted_seconds * percent / 100, sampled)
+                for (key, (written, percent, rate, sampled)) in self.progress.items()]
+            self.dirty = False
+        dbconn.execSQL(conn, "DELETE FROM %s.%s WHERE driver = '%s'" % (
+            gpexpand_schema, table_progress_table, self.driver))
+        if rows:
+            dbconn.execSQL(conn, 'INSERT INTO %s.%s VALUES %s' % (
+                gpexpand_schema, table_progress_table, ', '.join(rows)))
+        conn.commit()
+
+    def stop(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+
+# -----------------------------------------------
+class ExpansionMetrics:
+    """In-process metrics of a running expansion in the OpenMetrics text format,
+    served on localhost and/or rewritten into a textfile.  The expand workers
+    report table starts and finishes; the main loop adds the status counters
+    and the lock waits of the workers' backends every few seconds."""
+
+    def __init__(self, logger, port=None, path=None):
+        self.logger = logger
+        self.path = path
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.finished = []
+        self.counters = {'tables_finished': 0, 'table_failures': 0, 'online_fallbacks': 0}
+        self.status_tables = {}
+        self.status_bytes = {}
+        self.pending = 0
+        self.lock_waits = 0
+        self.movement = {}
+        self.table_progress = []
+        self.server = None
+        if port:
+            import BaseHTTPServer
+            metrics = self
+
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.render()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), Handler)
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.logger.info('Serving expansion metrics on http://127.0.0.1:%d/metrics' % port)
+
+    def table_started(self, table, pid):
+        with self.lock:
+            self.in_flight[(table.dbname, table.fq_name)] = (datetime.datetime.now(), pid)
+
+    def table_finished(self, table, success):
+        now = datetime.datetime.now()
+        with self.lock:
+            self.in_flight.pop((table.dbname, table.fq_name), None)
+            if success:
+                self.counters['tables_finished'] += 1
+                self.finished.append((now, float(table.source_bytes or 0)))
+            else:
+                self.counters['table_failures'] += 1
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def refresh(self, conn, pending, movement=None, table_progress=None):
+        """Reads the progress counters and lock waits; called from the main loop"""
+        sql = "SELECT status, tables, bytes FROM %s.%s" % (gpexpand_schema, progress_counters_table)
+        rows = dbconn.execSQL(conn, sql).fetchall()
+        with self.lock:
+            pids = [pid for (started, pid) in self.in_flight.values()]
+        lock_waits = 0
+        if pids:
+            sql = "SELECT count(*) FROM pg_catalog.pg_locks WHERE NOT granted AND pid IN (%s)" % (
+                ', '.join(str(pid) for pid in pids))
+            lock_waits = dbconn.execSQLForSingleton(conn, sql)
+        conn.commit()
+
+        with self.lock:
+            self.status_tables = dict((row[0], row[1]) for row in rows)
+            self.status_bytes = dict((row[0], row[2]) for row in rows)
+            self.pending = pending
+            self.lock_waits = lock_waits
+            self.movement = movement or {}
+            self.table_progress = table_progress or []
+        if self.path:
+            self.write_textfile()
+
+    def write_textfile(self):
+        temp_path = '%s.tmp' % self.path
+        f = open(temp_path, 'w')
+        try:
+            f.write(self.render())
+        finally:
+            f.close()
+        os.rename(temp_path, self.path)
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @staticmethod
+    def _label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        now = datetime.datetime.now()
+        with self.lock:
+            self.finished = [(t, b) for (t, b) in self.finished
+                             if (now - t).total_seconds() <= METRICS_RATE_WINDOW]
+            window_bytes = sum(b for (t, b) in self.finished)
+            in_flight = sorted(self.in_flight.items())
+            counters = dict(self.counters)
+            status_tables = dict(self.status_tables)
+            status_bytes = dict(self.status_bytes)
+            pending = self.pending
+            lock_waits = self.lock_waits
+            movement = sorted(self.movement.items())
+            table_progress = list(self.table_progress)
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('# HELP %s %s' % (name, help))
+            suffix = '_total' if kind == 'counter' else ''
+            for (labels, value) in samples:
+                lines.append('%s%s%s %s' % (name, suffix, labels, value))
+
+        metric('gpexpand_queue_depth', 'gauge', 'Tables queued but not yet picked up by a worker.',
+               [('', max(pending - len(in_flight), 0))])
+        metric('gpexpand_workers_busy', 'gauge', 'Workers expanding a table.', [('', len(in_flight))])
+        metric('gpexpand_lock_waits', 'gauge', 'Worker backends waiting for a lock.', [('', lock_waits)])
+        metric('gpexpand_tables', 'gauge', 'Tables per expansion status.',
+               [('{status="%s"}' % self._label(s), v) for (s, v) in sorted(status_tables.items())])
+        metric('gpexpand_bytes', 'gauge', 'Source bytes per expansion status.',
+               [('{status="%s"}' % self._label(s), v) for (s, v) in sorted(status_bytes.items())])
+        metric('gpexpand_throughput_bytes_per_second', 'gauge',
+               'Bytes expanded per second over the last %d seconds.' % METRICS_RATE_WINDOW,
+               [('', '%.1f' % (window_bytes / METRICS_RATE_WINDOW))])
+        metric('gpexpand_table_in_flight_seconds', 'gauge', 'Seconds since each in-flight table was started.',
+               [('{database="%s",table="%s"}' % (self._label(db), self._label(name)),
+                 '%.1f' % (now - started).total_seconds()) for ((db, name), (started, pid)) in in_flight])
+        metric('gpexpand_table_progress_ratio', 'gauge', 'Share of each sampled in-flight table written so far.',
+               [('{database="%s",table="%s"}' % (self._label(db), self._label(name)), '%.4f' % (percent / 100))
+                for (db, name, percent, rate) in table_progress])
+        metric('gpexpand_table_write_bytes_per_second', 'gauge', 'Write rate of each sampled in-flight table.',
+               [('{database="%s",table="%s"}' % (self._label(db), self._label(name)), '%.1f' % rate)
+                for (db, name, percent, rate) in table_progress])
+        metric('gpexpand_host_bytes_in', 'counter', 'Bytes the segments of each host gained from redistribution.',
+               [('{host="%s"}' % self._label(host), bytes_in) for (host, (bytes_in, bytes_out)) in movement])
+        metric('gpexpand_host_bytes_out', 'counter', 'Bytes the segments of each host shed by redistribution.',
+               [('{host="%s"}' % self._label(host), bytes_out) for (host, (bytes_in, bytes_out)) in movement])
+        metric('gpexpand_tables_finished', 'counter', 'Tables expanded by this gpexpand.',
+               [('', counters['tables_finished'])])
+        metric('gpexpand_table_failures', 'counter', 'Table expansions that failed and were reset for a retry.',
+               [('', counters['table_failures'])])
+        metric('gpexpand_online_fallbacks', 'counter', 'Online redistributions retried with ALTER TABLE.',
+               [('', counters['online_fallbacks'])])
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+# -----------------------------------------------
+class ThroughputModel:
+    """Per-class rewrite cost learned from gpexpand_history.table_history.
+
+    Tables are classed by storage type, compression and whether they have
+    indexes.  For each class a least squares fit gives
+        seconds = overhead + bytes * seconds_per_byte * (1 + contention * (concurrency - 1))
+    with one contention factor shared by all classes, picked from a grid
+    so that the fits explain the history best.  Classes with fewer than
+    HISTORY_MIN_SAMPLES tables fall back to the storage type, then to all tables."""
+
+    def __init__(self, history=None):
+        self.fits = {}
+        self.samples = 0
+        self.contention = None
+        if history:
+            self._fit(history)
+
+    @staticmethod
+    def load(conn):
+        sql = """SELECT count(*) FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n
+                 ON (c.relnamespace = n.oid) WHERE n.nspname = '%s' AND c.relname = '%s'""" % (
+            history_schema, table_history_table)
+        if dbconn.execSQLForSingleton(conn, sql) == 0:
+            return ThroughputModel()
+        sql = """SELECT relstorage, compresstype, indexes, source_bytes, seconds, concurrency
+                 FROM %s.%s WHERE seconds > 0 AND source_bytes > 0""" % (history_schema, table_history_table)
+        history = [(r[0], r[1], int(r[2]), float(r[3]), float(r[4]), int(r[5]))
+                   for r in dbconn.execSQL(conn, sql)]
+        conn.commit()
+        return ThroughputModel(history)
+
+    @staticmethod
+    def compresstype(reloptions):
+        options = dict(o.split('=', 1) for o in (reloptions or '').split(',') if '=' in o)
+        compresstype = options.get('compresstype', 'none').lower()
+        if compresstype == 'none' and int(options.get('compresslevel', 0)) > 0:
+            compresstype = 'zlib'
+        return compresstype
+
+    @staticmethod
+    def classes(relstorage, compresstype, indexes):
+        """The classes of a table, most specific first"""
+        return [(relstorage, compresstype, indexes > 0), (relstorage,), ()]
+
+    @staticmethod
+    def _least_squares(points):
+        """Fits y = a + b * x, or y = b * x when all x are equal, or y = a when
+        they are all 0"""
+        n = float(len(points))
+        mean_x = sum(x for (x, y) in points) / n
+        mean_y = sum(y for (x, y) in points) / n
+        var_x = sum((x - mean_x) ** 2 for (x, y) in points)
+        if var_x == 0:
+            return (0.0, mean_y / mean_x) if mean_x else (mean_y, 0.0)
+        b = sum((x - mean_x) * (y - mean_y) for (x, y) in points) / var_x
+        a = mean_y - b * mean_x
+        if a < 0 or b < 0:
+            return (0.0, max(sum(y for (x, y) in points) / max(sum(x for (x, y) in points), 1), 0.0))
+        return (a, b)
+
+    def _fit_classes(self, history, contention):
+        by_class = {}
+        for (relstorage, compresstype, indexes, source_bytes, seconds, concurrency) in history:
+            x = source_bytes * (1 + contention * (concurrency - 1))
+            for key in ThroughputModel.classes(relstorage, compresstype, indexes):
+                by_class.setdefault(key, []).append((x, seconds))
+
+        fits = {}
+        error = 0.0
+        for (key, points) in by_class.items():
+            if len(points) < HISTORY_MIN_SAMPLES:
+                continue
+            fits[key] = ThroughputModel._least_squares(points)
+            (a, b) = fits[key]
+            error += sum(((a + b * x - y) / y) ** 2 for (x, y) in points)
+        return (fits, error)
+
+    def _fit(self, history):
+        self.samples = len(history)
+        best = None
+        for step in range(HISTORY_CONTENTION_STEPS + 1):
+            contention = float(step) / HISTORY_CONTENTION_STEPS
+            (fits, error) = self._fit_classes(history, contention)
+            if best is None or error < best[0]:
+                best = (error, fits, contention)
+            if len(set(h[5] for h in history)) < 2:
+                # one concurrency level says nothing about contention
+                break
+        (error, self.fits, contention) = best
+        if len(set(h[5] for h in history)) > 1:
+            self.contention = contention
+
+    def covers(self, relstorage):
+        return (relstorage,) in self.fits
+
+    def cost(self, table):
+        """(fixed, scaled, contention) seconds of an ExpansionEstimator table:
+        with n workers it takes fixed + scaled * (1 + contention * (n - 1))"""
+        for key in ThroughputModel.classes(table['storage'], table['compresstype'], table['indexes']):
+            if key in self.fits:
+                (overhead, seconds_per_byte) = self.fits[key]
+                return (overhead, table['bytes'] * seconds_per_byte, self.contention or 0)
+        return None
+
+    def predict(self, table, workers):
+        """Predicted seconds for an ExpansionEstimator table while workers tables expand at once"""
+        cost = self.cost(table)
+        if cost is None:
+            return None
+        (fixed, scaled, contention) = cost
+        return fixed + scaled * (1 + contention * (workers - 1))
+
+
+# -----------------------------------------------
+class ExpansionEstimator:
+    """Models the redistribution phase for --estimate.
+
+    Per storage type, a rewrite costs a fixed overhead plus bytes / rate, and
+    each index adds index_cost seconds per byte.  The rates and overheads come
+    from rewriting temporary copies of CALIBRATION_ROWS rows of a few sample
+    tables, so no expanded or status table is touched.  Contention between
+    workers is fitted from running CALIBRATION_STREAMS rewrites at once:
+    with n workers every rewrite is 1 + contention * (n - 1) times slower."""
+
+    storage_names = {'h': 'heap', 'a': 'append-optimized', 'c': 'column-oriented'}
+
+    def __init__(self, logger, dburl, options, model=None):
+        self.logger = logger
+        self.dburl = dburl
+        self.options = options
+        self.model = model or ThroughputModel()
+        self.tables = []
+        self.rate = {}
+        self.overhead = {}
+        self.index_cost = 0.0
+        self.analyze_cost = 0.0
+        self.contention = 0.0
+        self.costs = None
+
+    def _connect(self, dbname):
+        url = copy.deepcopy(self.dburl)
+        url.pgdb = dbname
+        return dbconn.connect(url, encoding='UTF8')
+
+    def collect(self):
+        """Reads the tables left to expand with their storage type and index count"""
+        conn = dbconn.connect(self.dburl, encoding='UTF8')
+        sql = """SELECT dbname, fq_name, table_oid, coalesce(source_bytes, 0), partition_root
+                 FROM %s.%s WHERE status IN ('%s', '%s') ORDER BY %s""" % (
+            gpexpand_schema, status_detail_table, undone_status, start_status,
+            'rank, scan_count DESC' if self.options.hot_first else 'rank')
+        rows = dbconn.execSQL(conn, sql).fetchall()
+        conn.close()
+
+        by_db = {}
+        for row in rows:
+            by_db.setdefault(row[0], []).append(row)
+
+        for (dbname, db_rows) in by_db.items():
+            conn = self._connect(dbname)
+            catalog_info = {}
+            try:
+                for i in range(0, len(db_rows), ESTIMATE_OID_CHUNK):
+                    sql = """SELECT c.oid, c.relstorage, array_to_string(c.reloptions, ','),
+                                    (SELECT count(*) FROM pg_catalog.pg_index i WHERE i.indrelid = c.oid)
+                             FROM pg_catalog.pg_class c WHERE c.oid IN (%s)""" % (
+                        ', '.join(str(row[2]) for row in db_rows[i:i + ESTIMATE_OID_CHUNK]))
+                    catalog_info.update((r[0], r[1:]) for r in dbconn.execSQL(conn, sql))
+            finally:
+                conn.close()
+            for row in db_rows:
+                if row[2] not in catalog_info:
+                    continue
+                (relstorage, reloptions, indexes) = catalog_info[row[2]]
+                self.tables.append({'dbname': dbname, 'fq_name': row[1], 'table_oid': row[2], 'bytes': int(row[3]),
+                                    'leaf': row[4] is not None, 'storage': relstorage,
+                                    'reloptions': reloptions, 'indexes': int(indexes),
+                                    'compresstype': ThroughputModel.compresstype(reloptions)})
+        self.costs = None
+
+    def _rewrite_seconds(self, conn, temp_name):
+        start = datetime.datetime.now()
+        dbconn.execSQL(conn, 'ALTER TABLE %s SET WITH(REORGANIZE=TRUE) DISTRIBUTED RANDOMLY' % temp_name)
+        conn.commit()
+        return (datetime.datetime.now() - start).total_seconds()
+
+    def _create_sample(self, conn, temp_name, table, rows):
+        (schema_name, table_name) = table['fq_name'].split('.')
+        with_clause = 'WITH (%s) ' % table['reloptions'] if table['reloptions'] else ''
+        dbconn.execSQL(conn, 'DROP TABLE IF EXISTS %s' % temp_name)
+        dbconn.execSQL(conn, 'CREATE TEMP TABLE %s %sAS SELECT * FROM "%s"."%s" LIMIT %d DISTRIBUTED RANDOMLY' % (
+            temp_name, with_clause, schema_name, table_name, rows))
+        conn.commit()
+        return int(dbconn.execSQLForSingleton(conn, "SELECT pg_relation_size('%s')" % temp_name))
+
+    def calibrate(self):
+        """Measures the storage types the history model has not seen yet"""
+        for storage in sorted(set(t['storage'] for t in self.tables)):
+            if self.model.covers(storage):
+                self.logger.info('Using %d past tables for %s tables' % (
+                    self.model.samples, self.storage_names.get(storage, storage)))
+                continue
+            samples = sorted([t for t in self.tables if t['storage'] == storage],
+                             key=lambda t: t['bytes'], reverse=True)[:CALIBRATION_SAMPLES]
+            total_bytes = 0
+            total_seconds = 0.0
+            overheads = []
+            for table in samples:
+                conn = self._connect(table['dbname'])
+                try:
+                    self._create_sample(conn, 'gpexpand_calibration', table, 0)
+                    overheads.append(self._rewrite_seconds(conn, 'gpexpand_calibration'))
+                    total_bytes += self._create_sample(conn, 'gpexpand_calibration', table, CALIBRATION_ROWS)
+                    total_seconds += max(self._rewrite_seconds(conn, 'gpexpand_calibration') - overheads[-1], 0.001)
+
+                    if storage == 'h' and not self.index_cost:
+                        (column,) = dbconn.execSQL(conn, """SELECT quote_ident(attname) FROM pg_catalog.pg_attribute
+                                                          WHERE attrelid = 'gpexpand_calibration'::regclass
+                                                          AND attnum = 1""").fetchone()
+                        sample_bytes = self._create_sample(conn, 'gpexpand_calibration', table, CALIBRATION_ROWS)
+                        dbconn.execSQL(conn, 'CREATE INDEX gpexpand_calibration_idx ON gpexpand_calibration (%s)' % column)
+                        conn.commit()
+                        with_index = self._rewrite_seconds(conn, 'gpexpand_calibration')
+                        plain = overheads[-1] + sample_bytes * total_seconds / max(total_bytes, 1)
+                        self.index_cost = max(with_index - plain, 0) / max(sample_bytes, 1)
+
+                    if self.options.analyze and not self.analyze_cost:
+                        start = datetime.datetime.now()
+                        dbconn.execSQL(conn, 'ANALYZE gpexpand_calibration')
+                        conn.commit()
+                        self.analyze_cost = (datetime.datetime.now() - start).total_seconds()
+                finally:
+                    conn.close()
+            self.overhead[storage] = sum(overheads) / len(overheads)
+            self.rate[storage] = total_bytes / max(total_seconds, 0.001)
+            self.logger.info('Calibrated %s tables: %.1f MB/s, %.2f s per table' % (
+                self.storage_names.get(storage, storage), self.rate[storage] / 1024 / 1024,
+                self.overhead[storage]))
+
+        if self.model.contention is not None:
+            self.contention = self.model.contention
+        elif self.rate:
+            self._calibrate_contention()
+        self.costs = None
+
+    def _calibrate_contention(self):
+        """Runs CALIBRATION_STREAMS sample rewrites at once to fit the contention factor"""
+        table = max([t for t in self.tables if t['storage'] in self.rate], key=lambda t: t['bytes'])
+        pool = WorkerPool(numWorkers=CALIBRATION_STREAMS)
+        try:
+            for i in range(CALIBRATION_STREAMS):
+                pool.addCommand(CalibrationRewriteCommand('gpexpand calibration stream %d' % i, self, table))
+            pool.join()
+            streams = pool.getCompletedItems()
+        finally:
+            pool.haltWork()
+            pool.joinWorkers()
+
+        single = table['storage'] in self.rate and self.rate[table['storage']]
+        rates = [cmd.rate for cmd in streams if cmd.rate]
+        if single and len(rates) == CALIBRATION_STREAMS:
+            slowdown = single / (sum(rates) / len(rates))
+            self.contention = max(slowdown - 1, 0) / (CALIBRATION_STREAMS - 1)
+        self.logger.info('Calibrated contention: each additional worker slows rewrites by %.0f%%' % (
+            self.contention * 100))
+
+    def table_cost(self, table):
+        """(fixed, scaled, contention) seconds to expand one table, see ThroughputModel.cost"""
+        storage = table['storage']
+        if self.model.covers(storage) or not self.rate:
+            return self.model.cost(table)
+        rate = self.rate.get(storage) or min(self.rate.values())
+        scaled = table['bytes'] / rate + table['indexes'] * table['bytes'] * self.index_cost
+        fixed = self.overhead.get(storage, 0) + (self.analyze_cost if self.options.analyze else 0)
+        return (fixed, scaled, self.contention)
+
+    def table_seconds(self, table, workers):
+        """Predicted seconds to expand one table while workers tables expand at once"""
+        (fixed, scaled, contention) = self.table_cost(table)
+        return fixed + scaled * (1 + contention * (workers - 1))
+
+    def predict(self, workers):
+        """Simulates the queue with workers workers.  Returns (total, tail) seconds,
+        the tail being the time at the end with fewer tables than workers running."""
+        if self.costs is None:
+            self.costs = [self.table_cost(table) for table in self.tables]
+        slowdown = min(workers, len(self.tables)) - 1
+        finish = [0.0] * workers
+        for (fixed, scaled, contention) in self.costs:
+            heapq.heapreplace(finish, finish[0] + fixed + scaled * (1 + contention * slowdown))
+        return (max(finish), max(finish) - finish[0])
+
+    def report(self, workers):
+        if self.costs is None:
+            self.costs = [self.table_cost(table) for table in self.tables]
+        phases = {}
+        for (table, (fixed, scaled, contention)) in zip(self.tables, self.costs):
+            key = self.storage_names.get(table['storage'], table['storage'])
+            phases[key] = phases.get(key, 0) + fixed + scaled
+        index_seconds = sum(t['indexes'] * t['bytes'] * self.index_cost for t in self.tables)
+
+        (total, tail) = self.predict(workers)
+        self.logger.info('%d tables left to expand (%d partition leaves), %.1f GB' % (
+            len(self.tables), len([t for t in self.tables if t['leaf']]),
+            sum(t['bytes'] for t in self.tables) / 1024.0 / 1024 / 1024))
+        for (phase, seconds) in sorted(phases.items()):
+            self.logger.info('  %s tables: %s of single worker time' % (
+                phase, datetime.timedelta(seconds=int(seconds))))
+        self.logger.info('  of which index rebuilds: %s' % datetime.timedelta(seconds=int(index_seconds)))
+        if self.options.analyze:
+            self.logger.info('  of which ANALYZE: %s' % datetime.timedelta(
+                seconds=int(self.analyze_cost * len(self.tables))))
+        self.logger.info('Estimated expansion time with -n %d: %s (tail of %s)' % (
+            workers, datetime.timedelta(seconds=int(total)), datetime.timedelta(seconds=int(tail))))
+
+        # past the best -n more workers only add contention
+        predictions = []
+        for n in range(1, MAX_PARALLEL_EXPANDS + 1):
+            predictions.append((n, self.predict(n)[0]))
+            if n > 1 and predictions[-1][1] >= predictions[-2][1]:
+                break
+        best = min(seconds for (n, seconds) in predictions)
+        (suggested, seconds) = [p for p in predictions if p[1] <= best * (1 + ESTIMATE_TOLERANCE)][0]
+        self.logger.info('Suggested -n %d: estimated %s, higher values gain less than %d%%' % (
+            suggested, datetime.timedelta(seconds=int(seconds)), ESTIMATE_TOLERANCE * 100))
+
+
+class CalibrationRewriteCommand(SQLCommand):
+    """One of the concurrent sample rewrites of ExpansionEstimator"""
+
+    def __init__(self, name, estimator, table):
+        self.estimator = estimator
+        self.table = table
+        self.rate = None
+        SQLCommand.__init__(self, name)
+
+    def run(self, validateAfter=False):
+        conn = None
+        try:
+            conn = self.estimator._connect(self.table['dbname'])
+            sample_bytes = self.estimator._create_sample(conn, 'gpexpand_calibration', self.table, CALIBRATION_ROWS)
+            seconds = self.estimator._rewrite_seconds(conn, 'gpexpand_calibration')
+            seconds -= self.estimator.overhead.get(self.table['storage'], 0)
+            self.rate = sample_bytes / max(seconds, 0.001)
+        except Exception, ex:
+            logger.warn('Calibration stream failed: %s' % str(ex).strip())
+        finally:
+            if conn: conn.close()
+
+    def set_results(self, results):
+        raise ExecutionError("TODO:  must implement", None)
+
+    def get_results(self):
+        raise ExecutionError("TODO:  must implement", None)
+
+    def was_successful(self):
+        raise ExecutionError("TODO:  must implement", None)
+
+    def validate(self, expected_rc=0):
+        raise ExecutionError("TODO:  must implement", None)
+
+
+# -----------------------------------------------
+class HostProbe(Command):
+    """Collects in one ssh round trip what the setup needs to know about the
+    segments of one host: the heap checksum setting of the existing ones, the
+    free space under every data directory and filespace, and whether the
+    ports and directories of the new ones are free.  Listening sockets come
+    from netstat, or ss where netstat is not installed; a host that reports
+    none at all could not be checked."""
+
+    def __init__(self, name, host, old_segments, new_segments, ctxt=REMOTE):
+        self.host = host
+        self.dirs = []
+        self.ports = []
+        self.new_dirs = []
+        probes = []
+
+        for seg in old_segments:
+            probes.append("printf 'checksum %d '; $GPHOME/bin/pg_controldata %s 2>/dev/null | grep 'Data page checksum version'" % (
+                seg.getSegmentDbId(), HostProbe.quote(seg.getSegmentDataDirectory())))
+            for path in set(seg.getSegmentFilespaces().values() + [seg.getSegmentDataDirectory()]):
+                probes.append("printf 'free %d '; df -Pk %s 2>/dev/null | tail -1" % (
+                    len(self.dirs), HostProbe.quote(path)))
+                self.dirs.append(path)
+
+        for seg in new_segments:
+            for path in set(seg.getSegmentFilespaces().values() + [seg.getSegmentDataDirectory()]):
+                # the directory itself need not exist yet
+                probes.append("printf 'free %d '; df -Pk %s 2>/dev/null | tail -1" % (
+                    len(self.dirs), HostProbe.quote(os.path.dirname(path.rstrip('/')))))
+                self.dirs.append(path)
+                probes.append("printf 'entries %d '; ls -A %s 2>/dev/null | wc -l" % (
+                    len(self.new_dirs), HostProbe.quote(path)))
+                self.new_dirs.append(path)
+            for port in (seg.getSegmentPort(), seg.getSegmentReplicationPort()):
+                if port:
+                    probes.append("printf 'port %d '; %s | grep -c '[.:]%d '" % (port, HostProbe.LISTENING, port))
+                    self.ports.append(port)
+        if self.ports:
+            probes.append("printf 'listening '; %s | wc -l" % HostProbe.LISTENING)
+
+        self.listening = 0
+        self.checksums = {}
+        self.free_kb = {}
+        self.dir_entries = {}
+        self.ports_in_use = []
+        cmdStr = '; '.join('%s; echo' % probe for probe in probes)
+        Command.__init__(self, name, cmdStr, ctxt, host)
+
+    LISTENING = "(netstat -an 2>/dev/null || ss -an 2>/dev/null) | grep -i listen"
+
+    @staticmethod
+    def quote(path):
+        return "'%s'" % path.replace("'", "'\\''")
+
+    def run(self, validateAfter=False):
+        Command.run(self, validateAfter)
+        if not self.was_successful():
+            return
+        for line in self.get_results().stdout.splitlines():
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            if fields[0] == 'checksum' and len(fields) > 2:
+                self.checksums[int(fields[1])] = int(fields[-1])
+            elif fields[0] == 'free' and len(fields) > 5:
+                self.free_kb[self.dirs[int(fields[1])]] = int(fields[5])
+            elif fields[0] == 'entries' and len(fields) > 2:
+                self.dir_entries[self.new_dirs[int(fields[1])]] = int(fields[2])
+            elif fields[0] == 'port' and len(fields) > 2 and int(fields[2]) > 0:
+                self.ports_in_use.append(int(fields[1]))
+            elif fields[0] == 'listening':
+                self.listening = int(fields[1])
+
+
 # -----------------------------------------------
 class PrepFileSpaces(Command):
     """
@@ -2733,14 +5130,27 @@ class ExecuteSQLStatementsCommand(SQLCommand):
 
 # -----------------------------------------------
 class ExpandCommand(SQLCommand):
-    def __init__(self, name, status_url, table, options):
+    # the commands expanding a table right now, for the concurrency in the history
+    running = set()
+    running_lock = threading.Lock()
+
+    def __init__(self, name, status_url, table, options, catalog_maintenance=None, skew_verifier=None,
+                 metrics=None, segment_movement=None, table_progress=None):
         self.status_url = status_url
+        self.catalog_maintenance = catalog_maintenance
+        self.skew_verifier = skew_verifier
+        self.metrics = metrics
+        self.segment_movement = segment_movement
+        self.table_progress = table_progress
         self.table = table
         self.options = options
         self.cmdStr = "Expand %s.%s" % (table.dbname, table.fq_name)
         self.table_url = copy.deepcopy(status_url)
         self.table_url.pgdb = table.dbname
         self.table_expand_error = False
+        self.online_watermark = options.online_tables.get('%s.%s' % (table.dbname, table.fq_name))
+        self.queued = datetime.datetime.now()
+        self.concurrency = 1
 
         SQLCommand.__init__(self, name)
         pass
@@ -2750,10 +5160,17 @@ class ExpandCommand(SQLCommand):
         status_conn = None
         table_conn = None
         table_exp_success = False
+        self.table.timings = {}
+        self.table.spans = []
+        attempt_start = self.table.time_phase('queue_wait', self.queued)
 
         try:
             status_conn = dbconn.connect(self.status_url, encoding='UTF8')
-            table_conn = dbconn.connect(self.table_url, encoding='UTF8')
+            if self.online_watermark:
+                # the online swap carries the table privileges over in pg_class
+                table_conn = dbconn.connect(self.table_url, encoding='UTF8', allowSystemTableMods='dml')
+            else:
+                table_conn = dbconn.connect(self.table_url, encoding='UTF8')
         except DatabaseError, ex:
             if self.options.verbose:
                 logger.exception(ex)
@@ -2761,7 +5178,9 @@ class ExpandCommand(SQLCommand):
             if status_conn: status_conn.close()
             if table_conn: table_conn.close()
             self.table_expand_error = True
+            self._record_attempt('connect_failed', attempt_start)
             return
+        phase_start = self.table.time_phase('connect', attempt_start)
 
         # validate table hasn't been dropped
         start_time = None
@@ -2771,6 +5190,7 @@ class ExpandCommand(SQLCommand):
             where c.relname = '%s' and n.oid = c.relnamespace and n.nspname='%s'""" % (table_name, schema_name)
 
             cursor = dbconn.execSQL(table_conn, sql)
+            phase_start = self.table.time_phase('existence_check', phase_start)
 
             if cursor.rowcount == 0:
                 logger.info('%s.%s no longer exists in database %s' % (schema_name.decode('utf-8'),
@@ -2778,17 +5198,41 @@ class ExpandCommand(SQLCommand):
                                                                        self.table.dbname.decode('utf-8')))
 
                 self.table.mark_does_not_exist(status_conn, datetime.datetime.now())
+                self.table.time_phase('mark_does_not_exist', phase_start)
                 status_conn.close()
                 table_conn.close()
+                self._record_attempt('missing', attempt_start)
                 return
             else:
                 # Set conn for  cancel
                 self.cancel_conn = table_conn
                 start_time = datetime.datetime.now()
+                self._enter()
+                if self.metrics or self.table_progress:
+                    backend_pid = dbconn.execSQLForSingleton(table_conn, 'SELECT pg_backend_pid()')
+                    if self.metrics:
+                        self.metrics.table_started(self.table, backend_pid)
+                    if self.table_progress:
+                        self.table_progress.table_started(self.table, backend_pid)
                 if not self.options.simple_progress:
                     self.table.mark_started(status_conn, table_conn, start_time, self.cancel_flag)
 
-                table_exp_success = self.table.expand(table_conn, self.cancel_flag)
+                if self.online_watermark:
+                    try:
+                        phase_start = datetime.datetime.now()
+                        table_exp_success = self.table.expand_online(status_conn, table_conn,
+                                                                     self.online_watermark, self.cancel_flag)
+                        self.table.time_phase('online_redistribution', phase_start)
+                    except OnlineRedistributionError, ex:
+                        logger.warn('Online redistribution of %s.%s not possible, falling back to '
+                                    'ALTER TABLE: %s' % (self.table.dbname.decode('utf-8'),
+                                                         self.table.fq_name.decode('utf-8'), ex))
+                        self.table.set_phase(status_conn, fallback_phase)
+                        if self.metrics:
+                            self.metrics.count('online_fallbacks')
+                        table_exp_success = self.table.expand(table_conn, self.cancel_flag)
+                else:
+                    table_exp_success = self.table.expand(table_conn, self.cancel_flag)
 
         except Exception, ex:
             if ex.__str__().find('canceling statement due to user request') == -1 and not self.cancel_flag:
@@ -2801,6 +5245,7 @@ class ExpandCommand(SQLCommand):
             else:
                 logger.info('ALTER TABLE of %s.%s canceled' % (
                     self.table.dbname.decode('utf-8'), self.table.fq_name.decode('utf-8')))
+        self._leave()
 
         if table_exp_success:
             end_time = datetime.datetime.now()
@@ -2808,15 +5253,61 @@ class ExpandCommand(SQLCommand):
             logger.info(
                 "Finished expanding %s.%s" % (self.table.dbname.decode('utf-8'), self.table.fq_name.decode('utf-8')))
             self.table.mark_finished(status_conn, start_time, end_time)
+            self.table.time_phase('mark_finished', end_time)
+            try:
+                self.table.record_history(status_conn, table_conn, start_time, end_time, self.concurrency)
+            except Exception, ex:
+                logger.warn('Could not record the expansion history of %s.%s: %s' % (
+                    self.table.dbname.decode('utf-8'), self.table.fq_name.decode('utf-8'), ex.__str__().strip()))
+            if self.catalog_maintenance:
+                self.catalog_maintenance.record_rewrite(self.table.dbname)
+            if self.skew_verifier:
+                self.skew_verifier.submit(self.table)
+            if self.segment_movement and self.table.segment_bytes:
+                try:
+                    self.segment_movement.record(self.table.segment_bytes, self.table.segment_sizes(table_conn))
+                except Exception, ex:
+                    logger.debug('Could not measure the segment sizes of %s.%s: %s' % (
+                        self.table.dbname.decode('utf-8'), self.table.fq_name.decode('utf-8'), ex))
         elif not self.options.simple_progress:
             logger.info("Reseting status_detail for %s.%s" % (
                 self.table.dbname.decode('utf-8'), self.table.fq_name.decode('utf-8')))
+            phase_start = datetime.datetime.now()
             self.table.reset_started(status_conn)
+            self.table.time_phase('reset_started', phase_start)
+
+        if self.metrics and start_time:
+            self.metrics.table_finished(self.table, table_exp_success)
+        if self.table_progress and start_time:
+            self.table_progress.table_finished(self.table)
+        if table_exp_success:
+            self._record_attempt('expanded', attempt_start)
+        else:
+            self._record_attempt('failed' if self.table_expand_error else 'canceled', attempt_start)
 
         # disconnect
         status_conn.close()
         table_conn.close()
 
+    def _enter(self):
+        """Counts this table as running; the concurrency of every running table
+        is the most tables seen running at once while it ran"""
+        with ExpandCommand.running_lock:
+            ExpandCommand.running.add(self)
+            for cmd in ExpandCommand.running:
+                cmd.concurrency = max(cmd.concurrency, len(ExpandCommand.running))
+
+    def _leave(self):
+        with ExpandCommand.running_lock:
+            ExpandCommand.running.discard(self)
+
+    def _record_attempt(self, outcome, attempt_start):
+        journal.event('table', dbname=self.table.dbname, table=self.table.fq_name, outcome=outcome,
+                      bytes=self.table.source_bytes,
+                      seconds=(datetime.datetime.now() - attempt_start).total_seconds(),
+                      phases=self.table.timings)
+        timeline.add_attempt(self.table, outcome)
+
     def set_results(self, results):
         raise ExecutionError("TODO:  must implement", None)
 
@@ -2830,6 +5321,177 @@ class ExpandCommand(SQLCommand):
         raise ExecutionError("TODO:  must implement", None)
 
 
+# -----------------------------------------------
+class EventJournal:
+    """Append-only JSONL record of a gpexpand run for --journal.  Every line
+    is one event with its wall-clock time: a GpExpandStatus transition, a
+    gppylib command run through run() or a batch of them waited for through
+    join() with its duration, or a table attempt with the seconds spent in
+    each of its phases.  Records nothing until opened; run() and join() run
+    the commands either way."""
+
+    def __init__(self):
+        self.fp = None
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        self.fp = open(path, 'a')
+        self.event('start', pid=os.getpid(), argv=sys.argv[1:])
+
+    def event(self, kind, **fields):
+        if not self.fp:
+            return
+        fields['event'] = kind
+        fields['time'] = datetime.datetime.now().isoformat()
+        line = json.dumps(fields, default=str)
+        with self.lock:
+            self.fp.write(line + '\n')
+            self.fp.flush()
+
+    def run(self, cmd, validateAfter=False):
+        """Runs a gppylib Command, journaling how long it took"""
+        start = datetime.datetime.now()
+        try:
+            cmd.run(validateAfter=validateAfter)
+        finally:
+            self.event('command', name=cmd.name, host=getattr(cmd, 'remoteHost', None),
+                       seconds=(datetime.datetime.now() - start).total_seconds())
+
+    def join(self, pool, name):
+        """Waits for the commands queued on a WorkerPool, journaling how long
+        they took together under name"""
+        start = datetime.datetime.now()
+        try:
+            pool.join()
+        finally:
+            self.event('command', name=name, host=None, seconds=(datetime.datetime.now() - start).total_seconds())
+
+
+journal = EventJournal()
+
+
+class WorkerTimeline:
+    """Per-worker timeline of the table expansions for --trace, streamed as
+    Chrome trace-event JSON (the array format) for chrome://tracing or
+    Perfetto.  Every attempt is a span on the track of the worker thread that
+    ran it, with its phases nested inside; gaps between attempts are idle
+    workers.  Queue waits are spent before a worker picks the table up, so
+    they go in the span's args.  Events are written as attempts finish; the
+    closing bracket is optional in this format, so an interrupted run still
+    leaves a readable trace.  Does nothing until opened."""
+
+    def __init__(self):
+        self.fp = None
+        self.separator = ''
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.origin = datetime.datetime.now()
+
+    def open(self, path):
+        self.fp = open(path, 'w')
+        self.fp.write('[')
+        self.separator = '\n'
+        self.origin = datetime.datetime.now()
+
+    def _us(self, when):
+        return int((when - self.origin).total_seconds() * 1000000)
+
+    def _emit(self, events):
+        for event in events:
+            self.fp.write(self.separator + json.dumps(event))
+            self.separator = ',\n'
+        self.fp.flush()
+
+    def add_attempt(self, table, outcome):
+        if not self.fp:
+            return
+        thread = threading.current_thread()
+        spans = [span for span in table.spans if span[0] != 'queue_wait']
+        if not spans:
+            return
+        name = '%s.%s' % (table.dbname, table.fq_name)
+        (start, end) = (spans[0][1], spans[-1][2])
+        events = [{'name': name, 'cat': outcome, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                   'ts': self._us(start), 'dur': self._us(end) - self._us(start),
+                   'args': {'outcome': outcome, 'bytes': str(table.source_bytes),
+                            'queue_wait_seconds': table.timings.get('queue_wait', 0)}}]
+        for (phase, since, until) in spans:
+            events.append({'name': phase, 'cat': 'phase', 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                           'ts': self._us(since), 'dur': self._us(until) - self._us(since),
+                           'args': {'table': name}})
+        with self.lock:
+            if not self.fp:
+                return
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                events.insert(0, {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread.ident,
+                                  'args': {'name': thread.name}})
+            self._emit(events)
+
+    def close(self):
+        with self.lock:
+            if not self.fp:
+                return
+            self.fp.write('\n]\n')
+            self.fp.close()
+            self.fp = None
+
+
+timeline = WorkerTimeline()
+
+
+def summarize_journal(path):
+    """Prints where the time recorded by --journal went"""
+    statuses = []
+    commands = {}
+    phases = {}
+    outcomes = {}
+    attempts = []
+    f = open(path, 'r')
+    try:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event['event'] == 'status':
+                statuses.append((event['time'], event['status']))
+            elif event['event'] == 'command':
+                (count, seconds, longest) = commands.get(event['name'], (0, 0.0, 0.0))
+                commands[event['name']] = (count + 1, seconds + event['seconds'], max(longest, event['seconds']))
+            elif event['event'] == 'table':
+                outcomes[event['outcome']] = outcomes.get(event['outcome'], 0) + 1
+                for (phase, seconds) in event['phases'].items():
+                    phases[phase] = phases.get(phase, 0) + seconds
+                attempts.append((event['seconds'], event['dbname'], event['table'], event['outcome']))
+    finally:
+        f.close()
+
+    def parse_time(value):
+        if '.' not in value:
+            value += '.0'
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+
+    if statuses:
+        logger.info('Setup phases:')
+        for ((started, status), (finished, next_status)) in zip(statuses, statuses[1:]):
+            logger.info('  %-40s %10.1f s' % (status, (parse_time(finished) - parse_time(started)).total_seconds()))
+
+    if commands:
+        logger.info('Commands by total time:')
+        for (name, (count, seconds, longest)) in sorted(commands.items(), key=lambda c: -c[1][1])[:20]:
+            logger.info('  %-60s %6d runs %10.1f s total %8.1f s longest' % (name[:60], count, seconds, longest))
+
+    if attempts:
+        total = sum(phases.values())
+        logger.info('Table attempts: %s' % ', '.join('%d %s' % (n, o) for (o, n) in sorted(outcomes.items())))
+        logger.info('Worker time by phase:')
+        for (phase, seconds) in sorted(phases.items(), key=lambda p: -p[1]):
+            logger.info('  %-25s %12.1f s %5.1f%%' % (phase, seconds, 100.0 * seconds / max(total, 0.001)))
+        logger.info('Longest table attempts:')
+        for (seconds, dbname, table, outcome) in sorted(attempts, reverse=True)[:10]:
+            logger.info('  %s.%s (%s) %.1f s' % (dbname, table, outcome, seconds))
+
+
 # ------------------------------- UI Help --------------------------------
 def read_hosts_file(hosts_file):
     new_hosts = []
@@ -2850,6 +5512,54 @@ def read_hosts_file(hosts_file):
     return new_hosts
 
 
+def read_online_tables_file(online_file):
+    """Reads the --online file into a dict of dbname.schema.table -> watermark column"""
+    online_tables = {}
+    try:
+        f = open(online_file, 'r')
+        try:
+            for lineno, l in enumerate(f, 1):
+                if l.strip().startswith('#') or l.strip() == '':
+                    continue
+
+                (table, sep, watermark) = l.strip().rpartition(':')
+                if not sep or not table or not watermark.strip() or table.count('.') != 2:
+                    raise ExpansionError('Invalid entry on line %d of %s, expected '
+                                         'dbname.schema.table:watermark_column' % (lineno, online_file))
+                online_tables[table.strip()] = watermark.strip()
+
+        finally:
+            f.close()
+    except IOError:
+        raise ExpansionError('Online tables file %s not found' % online_file)
+
+    return online_tables
+
+
+def read_colocation_hints_file(colocate_file):
+    """Reads the --colocate file into a list of lists of dbname.schema.table"""
+    groups = []
+    try:
+        f = open(colocate_file, 'r')
+        try:
+            for lineno, l in enumerate(f, 1):
+                if l.strip().startswith('#') or l.strip() == '':
+                    continue
+
+                tables = [t.strip() for t in l.split(',') if t.strip()]
+                if len(tables) < 2 or [t for t in tables if t.count('.') != 2]:
+                    raise ExpansionError('Invalid entry on line %d of %s, expected two or more '
+                                         'comma separated dbname.schema.table' % (lineno, colocate_file))
+                groups.append(tables)
+
+        finally:
+            f.close()
+    except IOError:
+        raise ExpansionError('Colocation hints file %s not found' % colocate_file)
+
+    return groups
+
+
 def interview_setup(gparray, options):
     help = """
 System Expansion is used to add segments to an existing GPDB array.
@@ -3056,12 +5766,25 @@ def main(options, args, parser):
         logger = get_default_logger()
         setup_tool_logging(EXECNAME, getLocalHostname(), getUserName())
 
+        if options.summarize_journal:
+            # offline, no cluster needed
+            remove_pid = False
+            summarize_journal(options.summarize_journal)
+            sys.exit(0)
+
         options, args = validate_options(options, args, parser)
+        if options.journal:
+            journal.open(options.journal)
+        if options.trace:
+            timeline.open(options.trace)
 
         if options.verbose:
             enable_verbose_logging()
 
-        if is_gpexpand_running(options.master_data_directory):
+        if options.cooperative:
+            # cooperative drivers coordinate through gpexpand.drivers
+            remove_pid = False
+        elif is_gpexpand_running(options.master_data_directory):
             logger.error('gpexpand is already running.  Only one instance')
             logger.error('of gpexpand is allowed at a time.')
             remove_pid = False
@@ -3079,7 +5802,11 @@ def main(options, args, parser):
         if options.database:
             dburl.pgdb = options.database
 
-        gpexpand_db_status = gpexpand.prepare_gpdb_state(logger, dburl, options)
+        if options.cooperative:
+            # never change the cluster state underneath the other drivers
+            gpexpand_db_status = gpexpand.get_cooperative_status(dburl)
+        else:
+            gpexpand_db_status = gpexpand.prepare_gpdb_state(logger, dburl, options)
 
         # Get array configuration
         try:
@@ -3120,15 +5847,25 @@ def main(options, args, parser):
                 logger.error(e)
                 sys.exit(1)
 
-        if gpexpand_db_status == 'SETUP DONE' or gpexpand_db_status == 'EXPANSION STOPPED':
+        if options.estimate:
+            if gpexpand_db_status not in ('SETUP DONE', 'EXPANSION STOPPED', 'EXPANSION STARTED'):
+                logger.error('--estimate needs a finished expansion setup with tables left to expand.')
+                sys.exit(1)
+            _gp_expand.estimate_expansion()
+        elif gpexpand_db_status == 'SETUP DONE' or gpexpand_db_status == 'EXPANSION STOPPED':
             if not _gp_expand.validate_max_connections():
                 raise ValidationError()
+            if not options.cooperative and not _gp_expand.validate_no_live_drivers():
+                sys.exit(1)
             _gp_expand.perform_expansion()
         elif gpexpand_db_status == 'EXPANSION STARTED':
-            logger.info('It appears the last run of gpexpand did not exit cleanly.')
-            logger.info('Resuming the expansion process...')
+            if not options.cooperative:
+                logger.info('It appears the last run of gpexpand did not exit cleanly.')
+                logger.info('Resuming the expansion process...')
             if not _gp_expand.validate_max_connections():
                 raise ValidationError()
+            if not options.cooperative and not _gp_expand.validate_no_live_drivers():
+                sys.exit(1)
             _gp_expand.perform_expansion()
         elif gpexpand_db_status == 'EXPANSION COMPLETE':
             logger.info('Expansion has already completed.')
@@ -3144,9 +5881,11 @@ def main(options, args, parser):
                 if not options.silent:
                     if not ask_yesno(None, "Would you like to continue with System Expansion", 'N'):
                         raise ValidationError()
-            _gp_expand.validate_heap_checksums()
             newSegList = _gp_expand.read_input_files()
             _gp_expand.addNewSegments(newSegList)
+            _gp_expand.validate_heap_checksums()
+            if not _gp_expand.validate_new_segment_hosts():
+                raise ValidationError()
             _gp_expand.sync_packages()
             _gp_expand.start_prepare()
             _gp_expand.add_segments()